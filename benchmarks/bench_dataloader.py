@@ -0,0 +1,38 @@
+"""Benchmarks of the batches over sliding time windows
+(`fleming_lib.dataloader`)."""
+from datetime import timedelta
+
+from fleming_lib.dataloader import Dataloader
+
+from .common import ROWS, dataset
+
+
+class MakeTimeline(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.dataloader = Dataloader(dataset(n_rows))
+
+    def time_make_timeline(self, n_rows):
+        self.dataloader.make_timeline(step=timedelta(hours=1),
+                                      window=timedelta(hours=6))
+
+    def peakmem_make_timeline(self, n_rows):
+        self.dataloader.make_timeline(step=timedelta(hours=1),
+                                      window=timedelta(hours=6))
+
+
+class GetBatch(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.dataloader = Dataloader(dataset(n_rows))
+        self.dataloader.make_timeline(step=timedelta(hours=1),
+                                      window=timedelta(hours=6))
+
+    def time_get_batch(self, n_rows):
+        self.dataloader.get_batch(self.dataloader.n_times // 2)
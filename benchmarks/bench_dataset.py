@@ -0,0 +1,114 @@
+"""Benchmarks of the extraction and formatting of measures
+(`fleming_lib.dataset`)."""
+import numpy as np
+
+from fleming_lib.dataset import (_format_measures, create_dataset,
+                                 extract_measures)
+from fleming_lib.synthetic import connect_sqlite, generate_omop, load_omop
+
+from .common import ROWS, ROWWISE_MAX_ROWS, categories, measures, skip_above
+
+# Average number of measures per patient of the synthetic database
+_ROWS_PER_PATIENT = 390
+
+
+class Pivot(object):
+    """Conversion of measures to a timeseries matrix (`pivot='client'`)."""
+
+    params = ROWS
+    param_names = ['n_rows']
+    timeout = 3600
+
+    def setup(self, n_rows):
+        self.df = measures(n_rows)
+
+    def time_pivot(self, n_rows):
+        self.df.pivot_table(
+            index=['measurement_datetime', 'person_id'],
+            columns='measurement_concept_name', values='value_source_value',
+            aggfunc='first')
+
+    def peakmem_pivot(self, n_rows):
+        self.df.pivot_table(
+            index=['measurement_datetime', 'person_id'],
+            columns='measurement_concept_name', values='value_source_value',
+            aggfunc='first')
+
+
+class FormatMeasures(object):
+    """Targets, pivot and type conversions of a batch of measures."""
+
+    params = ([1000, 100000], [False, True])
+    param_names = ['n_rows', 'compact']
+    number = 1
+    warmup_time = 0
+
+    def setup(self, n_rows, compact):
+        skip_above(n_rows, ROWWISE_MAX_ROWS)
+        self.df = measures(n_rows)
+        self.categories = categories()
+
+    def time_format_measures(self, n_rows, compact):
+        _format_measures(self.df, self.categories, compact=compact)
+
+    def peakmem_format_measures(self, n_rows, compact):
+        _format_measures(self.df, self.categories, compact=compact)
+
+
+class Fetch(object):
+    """Extraction of measures from an SQLite database."""
+
+    params = (ROWS, ['read_sql', 'cursor'])
+    param_names = ['n_rows', 'fetch']
+    timeout = 3600
+
+    def setup_cache(self):
+        n_patients = -(-max(ROWS) // _ROWS_PER_PATIENT)
+        tables = generate_omop(n_patients, seed=0)
+        load_omop(tables, path='omop.db').close()
+        # Number of patients to extract to get (about) `n_rows` measures
+        counts = tables['measurement'].loc[
+            tables['measurement']['measurement_concept_id'] != 0,
+            'person_id'].value_counts().sort_index().cumsum()
+        return {n_rows: int(np.searchsorted(counts.values, n_rows)) + 1
+                for n_rows in ROWS}
+
+    setup_cache.timeout = 7200
+
+    def setup(self, n_patients, n_rows, fetch):
+        self.conn = connect_sqlite('omop.db')
+
+    def teardown(self, n_patients, n_rows, fetch):
+        self.conn.close()
+
+    def time_extract_measures(self, n_patients, n_rows, fetch):
+        extract_measures(self.conn, 'm.person_id <= {}'.format(
+            n_patients[n_rows]), fetch=fetch)
+
+    def peakmem_extract_measures(self, n_patients, n_rows, fetch):
+        extract_measures(self.conn, 'm.person_id <= {}'.format(
+            n_patients[n_rows]), fetch=fetch)
+
+
+class CreateDataset(object):
+    """Whole build of a dataset from an SQLite database."""
+
+    params = ([1000, 100000], ['client', 'sql'])
+    param_names = ['n_rows', 'pivot']
+    timeout = 3600
+
+    def setup(self, n_rows, pivot):
+        n_patients = -(-n_rows // _ROWS_PER_PATIENT)
+        self.conn = load_omop(generate_omop(n_patients, seed=0))
+        self.list_patients = list(range(1, n_patients + 1))
+
+    def teardown(self, n_rows, pivot):
+        self.conn.close()
+
+    def time_create_dataset(self, n_rows, pivot):
+        create_dataset(self.conn, self.list_patients,
+                       n_patients_per_batch=50, pivot=pivot)
+
+    def peakmem_create_dataset(self, n_rows, pivot):
+        create_dataset(self.conn, self.list_patients,
+                       n_patients_per_batch=50, pivot=pivot)
@@ -0,0 +1,21 @@
+"""Benchmarks of the resampling onto a regular time grid
+(`fleming_lib.grid`)."""
+from fleming_lib.grid import resample
+
+from .common import ROWS, dataset
+
+
+class Resample(object):
+
+    params = (ROWS, ['last', 'mean'])
+    param_names = ['n_rows', 'agg']
+    columns = ['Respiratory rate', 'Heart rate', 'Mean blood pressure']
+
+    def setup(self, n_rows, agg):
+        self.df = dataset(n_rows)
+
+    def time_resample(self, n_rows, agg):
+        resample(self.df, self.columns, freq='1h', agg=agg, max_bins=48)
+
+    def peakmem_resample(self, n_rows, agg):
+        resample(self.df, self.columns, freq='1h', agg=agg, max_bins=48)
@@ -0,0 +1,94 @@
+"""Benchmarks of the additional features and targets (`fleming_lib.metrics`
+and `fleming_lib.rolling`), applied as in `create_dataset`."""
+from fleming_lib.metrics import (add_age, add_horizon_targets,
+                                 add_rolling_avg, add_super_target,
+                                 add_target)
+from fleming_lib.rolling import add_rolling_stats
+
+from .common import ROWS, dataset, measures
+
+
+class AddAge(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+    # `birth_datetime` is dropped: setup is run before each call
+    number = 1
+    warmup_time = 0
+
+    def setup(self, n_rows):
+        self.df = dataset(n_rows)
+
+    def time_add_age(self, n_rows):
+        add_age(self.df, round_to_dec=1)
+
+    def peakmem_add_age(self, n_rows):
+        add_age(self.df, round_to_dec=1)
+
+
+class AddTarget(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.df = measures(n_rows)
+
+    def time_add_target(self, n_rows):
+        add_target(self.df)
+
+    def peakmem_add_target(self, n_rows):
+        add_target(self.df)
+
+    def time_add_super_target(self, n_rows):
+        add_super_target(self.df, by='person_id')
+
+    def peakmem_add_super_target(self, n_rows):
+        add_super_target(self.df, by='person_id')
+
+    def time_add_horizon_targets(self, n_rows):
+        add_horizon_targets(self.df, by='person_id')
+
+    def peakmem_add_horizon_targets(self, n_rows):
+        add_horizon_targets(self.df, by='person_id')
+
+
+class AddRollingAvg(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.df = dataset(n_rows)
+
+    def time_add_rolling_avg(self, n_rows):
+        add_rolling_avg(self.df, 'Respiratory rate', 2, by='person_id')
+
+    def peakmem_add_rolling_avg(self, n_rows):
+        add_rolling_avg(self.df, 'Respiratory rate', 2, by='person_id')
+
+    def time_add_rolling_avg_multiple(self, n_rows):
+        add_rolling_avg(self.df, ['Respiratory rate', 'Heart rate',
+                                  'Mean blood pressure'], [2, 6, 24],
+                        by='person_id')
+
+    def peakmem_add_rolling_avg_multiple(self, n_rows):
+        add_rolling_avg(self.df, ['Respiratory rate', 'Heart rate',
+                                  'Mean blood pressure'], [2, 6, 24],
+                        by='person_id')
+
+
+class AddRollingStats(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+    columns = ['Respiratory rate', 'Heart rate', 'Mean blood pressure']
+
+    def setup(self, n_rows):
+        self.df = dataset(n_rows)
+
+    def time_add_rolling_stats(self, n_rows):
+        add_rolling_stats(self.df, self.columns)
+
+    def peakmem_add_rolling_stats(self, n_rows):
+        add_rolling_stats(self.df, self.columns)
@@ -0,0 +1,39 @@
+"""Benchmarks of the execution of stages on a pool of processes
+(`fleming_lib.parallel`)."""
+from fleming_lib.metrics import add_rolling_avg
+from fleming_lib.parallel import apply_by_patient
+from fleming_lib.severity_scores import compute_sofa_score
+
+from .common import (ROWS, ROWWISE_MAX_ROWS, dataset, scores_input,
+                     skip_above)
+
+N_WORKERS = [1, 2, 4, 8]
+
+
+class ApplyByPatient(object):
+
+    params = (ROWS, N_WORKERS)
+    param_names = ['n_rows', 'n_workers']
+
+    def setup(self, n_rows, n_workers):
+        self.df = dataset(n_rows)
+
+    def time_add_rolling_avg(self, n_rows, n_workers):
+        apply_by_patient(self.df, add_rolling_avg,
+                         {'column': ['Respiratory rate', 'Heart rate'],
+                          'window': [2, 6, 24], 'by': 'person_id'},
+                         n_workers=n_workers)
+
+
+class ApplyByRow(object):
+
+    params = (ROWS, N_WORKERS)
+    param_names = ['n_rows', 'n_workers']
+
+    def setup(self, n_rows, n_workers):
+        skip_above(n_rows, ROWWISE_MAX_ROWS)
+        self.df = scores_input(n_rows)
+
+    def time_compute_sofa_score(self, n_rows, n_workers):
+        apply_by_patient(self.df, compute_sofa_score, how='row',
+                         n_workers=n_workers)
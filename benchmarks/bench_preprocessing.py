@@ -0,0 +1,22 @@
+"""Benchmarks of preprocessing (`fleming_lib.preprocessing`), applied to all
+patients at once."""
+from datetime import timedelta
+
+from fleming_lib.preprocessing import fill_last_upto
+
+from .common import ROWS, dataset
+
+
+class FillLastUpto(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.df = dataset(n_rows)
+
+    def time_fill_last_upto(self, n_rows):
+        fill_last_upto(self.df, h=timedelta(hours=24), by='person_id')
+
+    def peakmem_fill_last_upto(self, n_rows):
+        fill_last_upto(self.df, h=timedelta(hours=24), by='person_id')
@@ -0,0 +1,48 @@
+"""Benchmarks of the ragged store of each patient timeseries
+(`fleming_lib.ragged`)."""
+import os
+import shutil
+import tempfile
+
+from fleming_lib.ragged import open_ragged, write_ragged
+
+from .common import ROWS, dataset
+
+
+class WriteRagged(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.df = dataset(n_rows)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, 'store')
+
+    def teardown(self, n_rows):
+        shutil.rmtree(self.tmp_dir)
+
+    def time_write_ragged(self, n_rows):
+        write_ragged(self.df, self.store_dir)
+
+
+class ReadRagged(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, 'store')
+        write_ragged(dataset(n_rows), self.store_dir)
+        self.store = open_ragged(self.store_dir)
+
+    def teardown(self, n_rows):
+        shutil.rmtree(self.tmp_dir)
+
+    def time_open_ragged(self, n_rows):
+        open_ragged(self.store_dir)
+
+    def time_get_all_patients(self, n_rows):
+        for person_id in self.store:
+            self.store.get_values(person_id).sum()
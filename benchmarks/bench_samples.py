@@ -0,0 +1,38 @@
+"""Benchmarks of the sliding-window samples (`fleming_lib.samples`)."""
+import os
+import shutil
+import tempfile
+
+from fleming_lib.metrics import add_horizon_targets
+from fleming_lib.ragged import open_ragged, write_ragged
+from fleming_lib.samples import from_ragged
+
+from .common import ROWS, dataset
+
+
+class WindowSampler(object):
+
+    params = (ROWS, [1., .1])
+    param_names = ['n_rows', 'negative_rate']
+
+    def setup(self, n_rows, negative_rate):
+        df = add_horizon_targets(dataset(n_rows), by='person_id')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, 'store')
+        write_ragged(df, self.store_dir)
+        self.store = open_ragged(self.store_dir)
+
+    def teardown(self, n_rows, negative_rate):
+        shutil.rmtree(self.tmp_dir)
+
+    def time_iter_batches(self, n_rows, negative_rate):
+        for X, y in from_ragged(self.store, 'target h+24', length=24,
+                                negative_rate=negative_rate, shuffle=True,
+                                seed=0):
+            pass
+
+    def peakmem_iter_batches(self, n_rows, negative_rate):
+        for X, y in from_ragged(self.store, 'target h+24', length=24,
+                                negative_rate=negative_rate, shuffle=True,
+                                seed=0):
+            pass
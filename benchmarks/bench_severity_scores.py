@@ -0,0 +1,28 @@
+"""Benchmarks of severity scores (`fleming_lib.severity_scores`), applied row
+by row as in the notebooks."""
+from fleming_lib.severity_scores import (compute_sapsii_score,
+                                         compute_sofa_score)
+
+from .common import ROWS, ROWWISE_MAX_ROWS, scores_input, skip_above
+
+
+class SeverityScores(object):
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        skip_above(n_rows, ROWWISE_MAX_ROWS)
+        self.df = scores_input(n_rows)
+
+    def time_sapsii_score(self, n_rows):
+        self.df.apply(compute_sapsii_score, axis=1)
+
+    def peakmem_sapsii_score(self, n_rows):
+        self.df.apply(compute_sapsii_score, axis=1)
+
+    def time_sofa_score(self, n_rows):
+        self.df.apply(compute_sofa_score, axis=1)
+
+    def peakmem_sofa_score(self, n_rows):
+        self.df.apply(compute_sofa_score, axis=1)
@@ -0,0 +1,77 @@
+"""Benchmarks of type conversions (`fleming_lib.utils`)."""
+from fleming_lib.concepts import MEASUREMENTS
+from fleming_lib.utils import (convert_frac, to_categorical, to_numeric,
+                               to_onehot)
+
+from .common import ROWS, categories, timeseries
+
+
+class ConvertFrac(object):
+    """Conversion of literal fractions of numerical variables."""
+
+    params = ROWS
+    param_names = ['n_rows']
+    timeout = 3600
+    # Variables are converted in place: setup is run before each call
+    number = 1
+    warmup_time = 0
+
+    def setup(self, n_rows):
+        self.df = timeseries(n_rows)
+
+    def time_convert_frac(self, n_rows):
+        convert_frac(self.df, MEASUREMENTS.numerical)
+
+    def peakmem_convert_frac(self, n_rows):
+        convert_frac(self.df, MEASUREMENTS.numerical)
+
+
+class ToNumeric(object):
+    """Conversion of numerical variables (after `convert_frac`)."""
+
+    params = ROWS
+    param_names = ['n_rows']
+    timeout = 3600
+    # Variables are converted in place: setup is run before each call
+    number = 1
+    warmup_time = 0
+
+    def setup(self, n_rows):
+        df = timeseries(n_rows)
+        # Mix of floats and strings, as left by `convert_frac`
+        df[MEASUREMENTS.numerical] = df[MEASUREMENTS.numerical].astype(object)
+        self.df = df
+
+    def time_to_numeric(self, n_rows):
+        to_numeric(self.df, MEASUREMENTS.numerical)
+
+    def peakmem_to_numeric(self, n_rows):
+        to_numeric(self.df, MEASUREMENTS.numerical)
+
+
+class Categorical(object):
+    """Conversion of categorical variables and one-hot encoding."""
+
+    params = ROWS
+    param_names = ['n_rows']
+
+    def setup(self, n_rows):
+        self.df = timeseries(n_rows)[MEASUREMENTS.categorical]
+        self.categories = categories()
+        self.categorical_df = to_categorical(self.df.copy(),
+                                             MEASUREMENTS.categorical,
+                                             self.categories)
+
+    def time_to_categorical(self, n_rows):
+        to_categorical(self.df.copy(), MEASUREMENTS.categorical,
+                       self.categories)
+
+    def peakmem_to_categorical(self, n_rows):
+        to_categorical(self.df.copy(), MEASUREMENTS.categorical,
+                       self.categories)
+
+    def time_to_onehot(self, n_rows):
+        to_onehot(self.categorical_df.copy(), MEASUREMENTS.categorical)
+
+    def peakmem_to_onehot(self, n_rows):
+        to_onehot(self.categorical_df.copy(), MEASUREMENTS.categorical)
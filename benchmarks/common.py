@@ -0,0 +1,132 @@
+"""Synthetic data shared by benchmarks.
+
+Data are generated once with `fleming_lib.synthetic` for a few hundred
+patients, then tiled (with new patients ID) up to the number of rows of each
+benchmark.
+"""
+import os
+import sys
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Benchmarks are run from the repository, which is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fleming_lib.concepts import MEASUREMENTS  # noqa: E402
+from fleming_lib.dataset import _format_measures  # noqa: E402
+from fleming_lib.synthetic import generate_omop  # noqa: E402
+from fleming_lib.utils import add_categories  # noqa: E402
+
+# Number of rows of the input of each benchmarked stage
+ROWS = [1000, 100000, 10000000]
+
+# Stages applied row by row are too slow beyond this number of rows
+ROWWISE_MAX_ROWS = 100000
+
+# Number of patients of the generated data, before tiling
+_N_PATIENTS = 300
+
+
+def skip_above(n_rows, max_rows):
+    """Skip a benchmark (as done by asv) beyond a given number of rows."""
+    if n_rows > max_rows:
+        raise NotImplementedError('Too slow beyond {} rows.'.format(max_rows))
+
+
+@lru_cache()
+def tables():
+    """Tables of the synthetic OMOP database."""
+    return generate_omop(_N_PATIENTS, seed=0)
+
+
+@lru_cache()
+def categories():
+    """Categories of each categorical variable."""
+    measurement = tables()['measurement']
+    categories = dict()
+    for var in MEASUREMENTS.categorical:
+        values = measurement.loc[
+            measurement['measurement_concept_name'] == var,
+            ['value_source_value']].drop_duplicates()
+        categories = add_categories(
+            categories, values.rename(columns={'value_source_value': var}),
+            var)
+    return categories
+
+
+def measures(n_rows):
+    """Measures, as returned by `fleming_lib.dataset.extract_measures`."""
+    return tile(_base_measures(), n_rows)
+
+
+def timeseries(n_rows):
+    """Timeseries matrix before any type conversion (raw string values)."""
+    df = _base_measures().pivot_table(
+        index=['measurement_datetime', 'person_id'],
+        columns='measurement_concept_name', values='value_source_value',
+        aggfunc='first')
+    df.reset_index(inplace=True)
+    df.columns.name = None
+    return tile(df, n_rows)
+
+
+def dataset(n_rows):
+    """Typed timeseries matrix, along with `birth_datetime`.
+
+    Categorical variables are kept as 'category' (`compact=True`).
+    """
+    return tile(_base_dataset(), n_rows)
+
+
+def scores_input(n_rows):
+    """Dataset with the columns used by severity scores."""
+    df = dataset(n_rows)
+    df = df.rename(columns={'Body temperature': 'bodyTemperature_C'})
+    df['age'] = ((df['measurement_datetime'] - df['birth_datetime']).dt.days
+                 / 365.25)
+    # Variables not extracted by `create_dataset`
+    rng = np.random.RandomState(0)
+    df['Creatinine serum/plasma'] = rng.uniform(.5, 5, len(df))
+    df['Platelets [#/volume] in Blood by Automated count'] = rng.uniform(
+        10, 400, len(df))
+    return df
+
+
+@lru_cache()
+def _base_measures():
+    """Measures of the generated patients (before tiling)."""
+    tab = tables()
+    df = tab['measurement']
+    df = df[df['measurement_concept_id'] != 0]
+    df = df.merge(tab['death'][['person_id', 'death_datetime']], how='left',
+                  on='person_id')
+    df = df.sort_values(['measurement_datetime', 'value_source_value'],
+                        kind='mergesort')
+    df = df[['person_id', 'measurement_datetime', 'measurement_concept_name',
+             'value_source_value', 'unit_source_value', 'death_datetime']]
+    return df.reset_index(drop=True)
+
+
+@lru_cache()
+def _base_dataset():
+    """Formatted measures of the generated patients (before tiling)."""
+    tab = tables()
+    df = _format_measures(_base_measures().copy(), categories(),
+                          compact=True)
+    df = df.merge(tab['person'][['person_id', 'birth_datetime']],
+                  how='inner', on='person_id')
+    return df.merge(tab['death'][['person_id', 'death_datetime']],
+                    how='left', on='person_id')
+
+
+def tile(df, n_rows):
+    """Repeat a dataframe (with new patients ID) up to a number of rows."""
+    n_copies = -(-n_rows // len(df))
+    offset = df['person_id'].max()
+    frame = [df.assign(person_id=df['person_id'] + k * offset)
+             for k in range(n_copies)]
+    df = pd.concat(frame, ignore_index=True) if n_copies > 1 else df.copy()
+    return df.iloc[:n_rows].copy()
@@ -0,0 +1,107 @@
+"""Persistent disk cache for data extracted from the OMOP database."""
+import glob
+import hashlib
+import os
+import pickle as pkl
+import time
+
+from fleming_lib.checkpoint import atomic_write
+
+
+def fingerprint(*parts):
+    """Compute a fingerprint identifying cached data.
+
+    Parameters
+    ----------
+    *parts : objects
+        Anything the cached data depends on (queries, parameters...). They are
+        hashed through their string representation.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal fingerprint.
+
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def load_cache(cache_dir, name, key, ttl=None):
+    """Load cached data.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory.
+    name : str
+        Name of the cached data.
+    key : str
+        Fingerprint of the cached data (see `fingerprint`).
+    ttl : datetime.timedelta | None
+        Time to live of the cached data. Older data are considered as missing.
+        If None, cached data never expire.
+
+    Returns
+    -------
+    value : object | None
+        Cached data, or None if missing or expired.
+
+    """
+    file = _cache_file(cache_dir, name, key)
+    if not os.path.isfile(file):
+        return None
+    with open(file, 'rb') as f:
+        entry = pkl.load(f)
+    if ttl is not None and time.time() - entry['created'] > \
+            ttl.total_seconds():
+        return None
+    return entry['value']
+
+
+def save_cache(cache_dir, name, key, value):
+    """Save data to cache.
+
+    Previous versions of the data (with a different fingerprint) are removed.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory (created if it does not exist).
+    name : str
+        Name of the cached data.
+    key : str
+        Fingerprint of the cached data (see `fingerprint`).
+    value : object
+        Data to cache (must be picklable).
+
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    clear_cache(cache_dir, name)
+    entry = {'created': time.time(), 'value': value}
+    # An interrupted write never leaves a corrupted cache entry behind
+    atomic_write(_cache_file(cache_dir, name, key), entry, binary=True)
+
+
+def clear_cache(cache_dir, name=None):
+    """Remove cached data.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory.
+    name : str | None
+        Name of the cached data to remove. If None, remove all cached data.
+
+    """
+    pattern = '*.pkl' if name is None else '{}-*.pkl'.format(name)
+    for file in glob.glob(os.path.join(cache_dir, pattern)):
+        os.remove(file)
+
+
+def _cache_file(cache_dir, name, key):
+    """Path of the file containing cached data."""
+    return os.path.join(cache_dir, '{}-{}.pkl'.format(name, key))
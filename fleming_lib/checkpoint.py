@@ -0,0 +1,114 @@
+"""Checkpoints of dataset builds, so that interrupted builds can be resumed."""
+import glob
+import json
+import os
+import pickle as pkl
+import tempfile
+import threading
+import warnings
+
+MANIFEST = 'manifest.json'
+
+
+class Checkpoint(object):
+    """Directory durably storing the completed batches of a build.
+
+    A manifest records the fingerprint of the build (see
+    `fleming_lib.cache.fingerprint`) and the index of every completed batch.
+    Opening a checkpoint directory with another fingerprint discards its
+    content.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Checkpoint directory (created if it does not exist).
+    key : str
+        Fingerprint of the arguments of the build.
+
+    """
+
+    def __init__(self, checkpoint_dir, key):
+        self.checkpoint_dir = checkpoint_dir
+        self.key = key
+        self._lock = threading.Lock()
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        manifest = self._read_manifest()
+        if manifest is not None and manifest['key'] == key:
+            self.completed = set(manifest['completed'])
+        else:
+            if manifest is not None:
+                wrn = ('Checkpoint in {} was created with other arguments: '
+                       'discarding it.'.format(checkpoint_dir))
+                warnings.warn(wrn)
+            for file in glob.glob(os.path.join(checkpoint_dir,
+                                               'batch-*.pkl')):
+                os.remove(file)
+            self.completed = set()
+            self._write_manifest()
+
+    def __contains__(self, i):
+        """Whether the i-th batch is completed."""
+        return i in self.completed
+
+    def load(self, i):
+        """Load the i-th batch."""
+        with open(self._batch_file(i), 'rb') as f:
+            return pkl.load(f)
+
+    def save(self, i, batch):
+        """Durably save the i-th batch and mark it as completed."""
+        atomic_write(self._batch_file(i), batch, binary=True)
+        with self._lock:
+            self.completed.add(i)
+            self._write_manifest()
+
+    def _batch_file(self, i):
+        """Path of the file containing the i-th batch."""
+        return os.path.join(self.checkpoint_dir, 'batch-{:05d}.pkl'.format(i))
+
+    def _read_manifest(self):
+        """Read manifest, if any."""
+        file = os.path.join(self.checkpoint_dir, MANIFEST)
+        if not os.path.isfile(file):
+            return None
+        with open(file) as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        """Durably write manifest."""
+        manifest = {'key': self.key, 'completed': sorted(self.completed)}
+        atomic_write(os.path.join(self.checkpoint_dir, MANIFEST), manifest,
+                      binary=False)
+
+
+def atomic_write(file, obj, binary):
+    """Write an object into a file atomically.
+
+    The object is written into a temporary file of the same directory, which
+    then replaces `file`, so that readers never see a partially written file.
+    The temporary file is removed if writing fails.
+
+    Parameters
+    ----------
+    file : str
+        Path of the file.
+    obj : object
+        Object to write.
+    binary : bool
+        Whether to pickle the object (JSON otherwise).
+
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(file), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            if binary:
+                pkl.dump(obj, f, protocol=pkl.HIGHEST_PROTOCOL)
+            else:
+                json.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
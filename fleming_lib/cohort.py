@@ -0,0 +1,286 @@
+"""Build cohorts of patients on the server side.
+
+Inclusion criteria are SQL subqueries selecting `person_id`. They are
+composed into a single query (intersection of all criteria) which is
+materialized as a table on the server, so that patients ID never have to be
+shipped back and forth between the client and the database.
+"""
+from collections import namedtuple
+
+import pandas as pd
+
+Cohort = namedtuple('Cohort', ['table', 'person_ids', 'ranks'])
+Cohort.__doc__ = """Cohort materialized in a table.
+
+Parameters
+----------
+table : str
+    Name of the table containing the cohort (columns `person_id` and
+    `cohort_rank`, rank of the patient starting from 1).
+person_ids : list of int
+    Patients ID, sorted by rank.
+ranks : dict of int
+    Rank of each patient (passed as a key).
+"""
+
+# Source concepts of limitation of care
+LIMITATION_OF_CARE_CONCEPTS = [2001018843, 2001030812, 4127294]
+
+# Age (in years) at the start of a visit, for each SQL dialect
+_AGE_EXPRESSIONS = {
+    'monetdb': '(v.visit_start_date - p.birth_datetime)/365.25',
+    'sqlite': ('(julianday(v.visit_start_date) - '
+               'julianday(p.birth_datetime))/365.25'),
+    'duckdb': ("date_diff('day', p.birth_datetime, v.visit_start_date)"
+               "/365.25"),
+}
+
+# Creation of a table from a query, for each SQL dialect
+_CREATE_TABLE = {
+    'monetdb': 'create {}table {} as {} with data',
+    'sqlite': 'create {}table {} as {}',
+    'duckdb': 'create {}table {} as {}',
+}
+_TEMPORARY = {
+    'monetdb': 'local temporary ',
+    'sqlite': 'temporary ',
+    'duckdb': 'temporary ',
+}
+_ON_COMMIT = {
+    'monetdb': ' on commit preserve rows',
+    'sqlite': '',
+    'duckdb': '',
+}
+
+
+def icu_criterion():
+    """Select patients who stayed in an intensive care unit (ICU).
+
+    Neonatal ICUs are excluded.
+
+    Returns
+    -------
+    query : str
+        SQL query selecting `person_id`.
+
+    """
+    return """
+    select
+        distinct vd.person_id
+    from
+        visit_detail vd
+    join
+        care_site cs on cs.care_site_id = vd.care_site_id
+    where
+        (lower(cs.place_of_service_source_value) like '%intensive%'
+         or cs.place_of_service_source_value = 'Cardiac surgery recovery unit'
+         or cs.place_of_service_source_value = 'Coronary care unit')
+    and
+        lower(cs.place_of_service_source_value) not like '%neonatal%'
+    """
+
+
+def age_criterion(min_age=15, max_age=150, dialect='monetdb'):
+    """Select patients within an age range at the start of one of their visits.
+
+    Parameters
+    ----------
+    min_age : float (default=15)
+        Minimum age (in years, excluded).
+    max_age : float (default=150)
+        Maximum age (in years, excluded), to remove outliers.
+    dialect : 'monetdb' | 'sqlite' | 'duckdb' (default='monetdb')
+        SQL dialect of the database.
+
+    Returns
+    -------
+    query : str
+        SQL query selecting `person_id`.
+
+    """
+    age = _AGE_EXPRESSIONS[dialect]
+    return """
+    select
+        distinct p.person_id
+    from
+        person p
+    join
+        visit_occurrence v on v.person_id = p.person_id
+    where
+        {age} > {min_age}
+    and
+        {age} < {max_age}
+    """.format(age=age, min_age=min_age, max_age=max_age)
+
+
+def measurement_criterion(source_concept_ids=None):
+    """Select patients with a measurement of given source concepts.
+
+    Parameters
+    ----------
+    source_concept_ids : list of int | None
+        Source concepts ID (`measurement_source_concept_id`). If None,
+        concepts of limitation of care are used.
+
+    Returns
+    -------
+    query : str
+        SQL query selecting `person_id`.
+
+    """
+    if source_concept_ids is None:
+        source_concept_ids = LIMITATION_OF_CARE_CONCEPTS
+    return """
+    select
+        distinct m.person_id
+    from
+        measurement m
+    where
+        m.measurement_source_concept_id in ({})
+    """.format(', '.join(str(concept_id)
+                         for concept_id in source_concept_ids))
+
+
+def cohort_query(criteria):
+    """Compose inclusion criteria into a single query.
+
+    Parameters
+    ----------
+    criteria : list of str
+        SQL queries selecting `person_id`.
+
+    Returns
+    -------
+    query : str
+        SQL query selecting `person_id` of patients matching all criteria,
+        along with their rank `cohort_rank` (by increasing `person_id`).
+
+    """
+    if not criteria:
+        raise ValueError('At least one criterion should be provided.')
+    intersection = '\n    intersect\n'.join(
+        '    select person_id from ({}) c{}'.format(criterion, i)
+        for i, criterion in enumerate(criteria))
+    return """
+    select
+        person_id, row_number() over (order by person_id) cohort_rank
+    from (
+{}
+    ) cohort
+    """.format(intersection)
+
+
+def build_cohort(conn, criteria=None, table='cohort', temporary=True,
+                 dialect=None):
+    """Materialize a cohort in a table of the database.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    criteria : list of str | None
+        SQL queries selecting `person_id`. If None, select patients who stayed
+        in ICU, older than 15 and with a limitation of care.
+    table : str (default='cohort')
+        Name of the table to create (replaced if it exists).
+    temporary : bool (default=True)
+        Whether to create a temporary table, only visible from `conn`. Use
+        False to build datasets with several connections (`n_workers > 1`).
+    dialect : 'monetdb' | 'sqlite' | 'duckdb' | None
+        SQL dialect of the database. If None, guessed from `conn`.
+
+    Returns
+    -------
+    cohort : Cohort
+        Materialized cohort, which can be passed to
+        `fleming_lib.dataset.create_dataset` instead of a list of patients.
+
+    """
+    if dialect is None:
+        dialect = guess_dialect(conn)
+    if criteria is None:
+        criteria = [icu_criterion(), age_criterion(dialect=dialect),
+                    measurement_criterion()]
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute('drop table if exists {}'.format(table))
+        query = _CREATE_TABLE[dialect].format(
+            _TEMPORARY[dialect] if temporary else '', table,
+            cohort_query(criteria))
+        if temporary:
+            query += _ON_COMMIT[dialect]
+        cursor.execute(query)
+    finally:
+        cursor.close()
+    conn.commit()
+
+    return load_cohort(conn, table)
+
+
+def load_cohort(conn, table='cohort'):
+    """Load a cohort already materialized in a table of the database.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    table : str (default='cohort')
+        Name of the table containing the cohort.
+
+    Returns
+    -------
+    cohort : Cohort
+        Materialized cohort.
+
+    """
+    query = """
+    select
+        person_id, cohort_rank
+    from
+        {}
+    order by
+        cohort_rank
+        ;""".format(table)
+
+    df = pd.read_sql_query(query, conn)
+    person_ids = df['person_id'].tolist()
+
+    return Cohort(table=table, person_ids=person_ids,
+                  ranks=dict(zip(person_ids, df['cohort_rank'].tolist())))
+
+
+def match_cohort(cohort, sublist_patients, column='m.person_id'):
+    """SQL condition matching a contiguous sublist of patients of a cohort.
+
+    Parameters
+    ----------
+    cohort : Cohort
+        Materialized cohort.
+    sublist_patients : list of int
+        Patients ID, contiguous in the cohort.
+    column : str (default='m.person_id')
+        Column to match.
+
+    Returns
+    -------
+    condition : str
+        SQL condition (semi-join on the cohort table).
+
+    """
+    first = cohort.ranks[sublist_patients[0]]
+    last = cohort.ranks[sublist_patients[-1]]
+    if last - first + 1 != len(sublist_patients):
+        raise ValueError('Patients should be contiguous in the cohort.')
+    return ("{} in (select person_id from {} where cohort_rank between {} "
+            "and {})".format(column, cohort.table, first, last))
+
+
+def guess_dialect(conn):
+    """Guess the SQL dialect of a connection from its module."""
+    module = type(conn).__module__
+    if module.startswith('sqlite3'):
+        return 'sqlite'
+    if module.startswith('duckdb'):
+        return 'duckdb'
+    return 'monetdb'
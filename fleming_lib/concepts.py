@@ -0,0 +1,131 @@
+"""Registry of the OMOP measurement concepts used to build a dataset.
+
+Each concept is declared once, along with the name of its column in the
+dataset, its type and its unit. The registry is compiled into the pieces used
+when building a dataset: SQL filter on concept IDs, column order and typed
+column schema.
+"""
+from collections import namedtuple
+
+Concept = namedtuple('Concept', ['concept_id', 'name', 'kind', 'dtype',
+                                 'unit'])
+Concept.__doc__ = """Measurement concept.
+
+Parameters
+----------
+concept_id : int
+    OMOP concept ID (`measurement_concept_id`).
+name : str
+    Name of the concept (`measurement_concept_name`), used as column name.
+kind : 'numerical' | 'categorical'
+    Kind of variable.
+dtype : str
+    Type of the column in the dataset (before one-hot encoding).
+unit : str | None
+    Unit of the values (`unit_source_value`), if any.
+"""
+
+ConceptPlan = namedtuple('ConceptPlan', [
+    'concepts', 'concept_ids', 'names', 'numerical', 'categorical',
+    'categorical_ids', 'dtypes', 'names_by_id'])
+ConceptPlan.__doc__ = """Registry compiled by `compile_concepts`.
+
+Parameters
+----------
+concepts : list of Concept
+    Concepts of the registry.
+concept_ids : str
+    Concept IDs formatted as a SQL list (e.g. for a `IN (...)` filter).
+names : list of str
+    Column names, in the order of the registry (as in the timeseries
+    matrix).
+numerical : list of str
+    Names of numerical variables.
+categorical : list of str
+    Names of categorical variables.
+categorical_ids : str
+    IDs of categorical concepts formatted as a SQL list.
+dtypes : dict of str
+    Type of each column (passed as a key).
+names_by_id : dict of str
+    Name of each concept (concept ID passed as a key).
+"""
+
+# Measurement concepts extracted for each patient
+MEASUREMENT_CONCEPTS = [
+    Concept(3022318, 'Heart rate rhythm', 'categorical', 'category', None),
+    Concept(3024171, 'Respiratory rate', 'numerical', 'float64', 'insp/min'),
+    Concept(3028354, 'Mean pressure Respiratory system airway Calculated',
+            'numerical', 'float64', 'cmH2O'),  # vent settings
+    Concept(3012888, 'BP diastolic', 'numerical', 'float64', 'mmHg'),
+    Concept(3027598, 'Mean blood pressure', 'numerical', 'float64', 'mmHg'),
+    Concept(3004249, 'BP systolic', 'numerical', 'float64', 'mmHg'),
+    Concept(3027018, 'Heart rate', 'numerical', 'float64', 'bpm'),
+    Concept(3020891, 'Body temperature', 'numerical', 'float64', 'deg C'),
+    Concept(3016502, 'Oxygen saturation in Arterial blood', 'numerical',
+            'float64', '%'),  # spo2
+    Concept(3020716, 'Oxygen concentration breathed', 'numerical', 'float64',
+            '%'),  # fio2
+    Concept(3032652, 'Glasgow coma scale', 'numerical', 'float64', None),
+    # chemicals
+    Concept(3019550, 'Sodium serum/plasma', 'numerical', 'float64',
+            'mEq/L'),  # natremie (fr)
+    Concept(3023103, 'Potassium serum/plasma', 'numerical', 'float64',
+            'mEq/L'),  # kaliemie (fr)
+    Concept(3024128, 'Total Bilirubin serum/plasma', 'numerical', 'float64',
+            'mg/dL'),
+    # hemato
+    Concept(3003282, 'Leukocytes [#/volume] in Blood by Manual count',
+            'numerical', 'float64', 'K/uL'),
+]
+
+
+def compile_concepts(concepts=None):
+    """Compile a registry of concepts.
+
+    Parameters
+    ----------
+    concepts : list of Concept | None
+        Concepts to compile. If None, `MEASUREMENT_CONCEPTS` are used.
+
+    Returns
+    -------
+    plan : ConceptPlan
+        Compiled registry.
+
+    """
+    if concepts is None:
+        concepts = MEASUREMENT_CONCEPTS
+
+    names_by_id = dict()
+    for concept in concepts:
+        if concept.kind not in ('numerical', 'categorical'):
+            raise ValueError('Unknown kind `{}` for concept `{}`.'.format(
+                concept.kind, concept.name))
+        if concept.concept_id in names_by_id:
+            raise ValueError('Concept {} declared twice.'.format(
+                concept.concept_id))
+        names_by_id[concept.concept_id] = concept.name
+
+    if len(set(names_by_id.values())) != len(names_by_id):
+        raise ValueError('Concept names should be unique.')
+
+    return ConceptPlan(
+        concepts=list(concepts),
+        concept_ids=_format_ids(concepts),
+        names=[c.name for c in concepts],
+        numerical=[c.name for c in concepts if c.kind == 'numerical'],
+        categorical=[c.name for c in concepts if c.kind == 'categorical'],
+        categorical_ids=_format_ids(
+            [c for c in concepts if c.kind == 'categorical']),
+        dtypes={c.name: c.dtype for c in concepts},
+        names_by_id=names_by_id)
+
+
+def _format_ids(concepts):
+    """Format ID of concepts as a SQL list."""
+    return ', '.join(str(c.concept_id) for c in concepts)
+
+
+# Compiled registry of measurement concepts
+MEASUREMENTS = compile_concepts()
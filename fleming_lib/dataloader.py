@@ -0,0 +1,188 @@
+"""Batches of measures over sliding time windows.
+
+The timeline of each patient is a sequence of times `start + i * step`, from
+its first measure up to (and including) the first time posterior or equal to
+its last measure. The batch of a time t is made of the measures of the
+patient within (t - window, t], going back by whole windows until a measure
+is found.
+
+All patients are indexed at once: rows are sorted once by patient and time,
+and the bounds of every batch are found with `np.searchsorted`, so that
+batches are (lazy) slices of the sorted dataframe.
+"""
+import warnings
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from .windows import searchsorted_by_group
+
+
+class Dataloader(object):
+    """Batches of measures of all patients over sliding time windows.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Dataset, with `measurement_datetime` and `by` columns.
+    by : str (default='person_id')
+        Column identifying patients.
+
+    Examples
+    --------
+    >>> dataloader = Dataloader(df)
+    >>> dataloader.make_timeline(step=timedelta(days=1),
+    ...                          window=timedelta(days=1))
+    >>> for batch in dataloader.iter_batches():
+    ...     X = dataloader.batch_to_matrix(batch)
+
+    """
+
+    def __init__(self, df, by='person_id'):
+        for column in ('measurement_datetime', by):
+            if column not in df:
+                raise ValueError('`{}` not in dataframe.'.format(column))
+        self.by = by
+        self.load_data(df)
+
+    def load_data(self, df):
+        """Sort and index the dataset (once for all patients)."""
+        times = df['measurement_datetime'].values.astype(
+            'datetime64[ns]').view('int64')
+        codes, person_ids = pd.factorize(df[self.by], sort=True)
+        order = np.lexsort((times, codes))
+        self.df = df.iloc[order]
+        self.person_ids = np.asarray(person_ids)
+        self.variables = df.columns.values
+        self._groups = codes[order].astype('int64')
+        self._times = times[order]
+
+        # Rows of each patient
+        self._bounds = np.searchsorted(self._groups,
+                                       np.arange(len(person_ids) + 1))
+        self.start_dt = self._times[self._bounds[:-1]].astype(
+            'datetime64[ns]')
+        self.end_dt = self._times[self._bounds[1:] - 1].astype(
+            'datetime64[ns]')
+        self.timeline = None
+
+    def make_timeline(self, start_dt=None, end_dt=None,
+                      step=timedelta(days=1), window=timedelta(days=1)):
+        """Compute the times and bounds of the batches of all patients.
+
+        Parameters
+        ----------
+        start_dt : datetime.datetime | None
+            Start of the timeline of every patient. If None, first measure of
+            each patient.
+        end_dt : datetime.datetime | None
+            End of the timeline of every patient. If None, last measure of
+            each patient. Patients whose timeline would end before its start
+            have no batch.
+        step : datetime.timedelta
+            Time between two batches.
+        window : datetime.timedelta
+            Time interval of each batch.
+
+        """
+        if start_dt is not None and end_dt is not None and start_dt > end_dt:
+            raise ValueError('`end_date` should be greater than `start_date`')
+        self.step = step
+        self.window = window
+        step = pd.Timedelta(step).value
+        window = pd.Timedelta(window).value
+
+        starts = self.start_dt.view('int64')
+        ends = self.end_dt.view('int64')
+        if start_dt is not None:
+            starts = np.full(len(starts), pd.Timestamp(start_dt).value)
+        if end_dt is not None:
+            ends = np.full(len(ends), pd.Timestamp(end_dt).value)
+
+        # Times start + i * step, up to the first one posterior or equal to
+        # the end
+        n_times = np.where(ends > starts, -(-(ends - starts) // step) + 1, 0)
+        groups = np.repeat(np.arange(len(n_times)), n_times)
+        firsts = np.cumsum(n_times) - n_times
+        indices = np.arange(len(groups)) - np.repeat(firsts, n_times)
+        times = starts[groups] + indices * step
+
+        # Batches (t - j * window, t], j being the smallest number of windows
+        # containing a measure
+        stops = searchsorted_by_group(self._groups, self._times, times,
+                                       query_groups=groups, side='right')
+        previous = np.maximum(stops - 1, 0)
+        is_found = (stops > 0) & (self._groups[previous] == groups)
+        n_windows = np.where(is_found,
+                             (times - self._times[previous]) // window + 1, 1)
+        starts = searchsorted_by_group(self._groups, self._times,
+                                        times - n_windows * window,
+                                        query_groups=groups, side='right')
+
+        self.timeline = times.astype('datetime64[ns]')
+        self.n_times = len(times)
+        self.n_batches = self.n_times
+        self._timeline_groups = groups
+        self._starts = starts
+        self._stops = stops
+        self._n_windows = n_windows
+
+    def get_time(self, i):
+        """Time of the batch `i`."""
+        self._check_index(i)
+        return pd.Timestamp(self.timeline[i])
+
+    def get_person_id(self, i):
+        """Patient of the batch `i`."""
+        self._check_index(i)
+        return self.person_ids[self._timeline_groups[i]]
+
+    def get_batch_indices(self, person_id):
+        """Indices of the batches of a patient.
+
+        Returns
+        -------
+        indices : range
+            Indices of the batches, in time order.
+
+        """
+        code = np.searchsorted(self.person_ids, person_id)
+        if code == len(self.person_ids) or self.person_ids[code] != person_id:
+            raise ValueError('Unknown patient {}.'.format(person_id))
+        first, last = np.searchsorted(self._timeline_groups, [code, code + 1])
+        return range(first, last)
+
+    def get_batch(self, i):
+        """Measures of the batch `i` (a slice of the sorted dataset)."""
+        self._check_index(i)
+        if self._n_windows[i] > 1:
+            time = self.get_time(i)
+            wrn = 'No data between {} and {}. Going back {}.'.format(
+                time, time - self._n_windows[i] * self.window, self.window)
+            warnings.warn(wrn)
+        return self.df.iloc[self._starts[i]:self._stops[i]]
+
+    def iter_batches(self, person_id=None):
+        """Iterate over the batches (of all patients, or of one patient)."""
+        if person_id is None:
+            indices = range(self.n_times)
+        else:
+            indices = self.get_batch_indices(person_id)
+        for i in indices:
+            yield self.get_batch(i)
+
+    def batch_to_matrix(self, batches):
+        """Values of a batch (or list of batches)."""
+        if not isinstance(batches, list):
+            return batches.values
+        else:
+            return [batch.values for batch in batches]
+
+    def _check_index(self, i):
+        if self.timeline is None:
+            raise ValueError('Timeline should be built first (see '
+                             '`make_timeline`).')
+        if not -self.n_times <= i < self.n_times:
+            raise ValueError('Cannot fetch batch {} (max {}).'.format(
+                i, self.n_times - 1))
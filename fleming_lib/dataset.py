@@ -1,250 +1,1035 @@
 """Functions to build a dataset."""
+import socket
 import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_float_dtype
 
+from fleming_lib.cache import fingerprint, load_cache, save_cache
+from fleming_lib.checkpoint import Checkpoint
+from fleming_lib.cohort import Cohort, match_cohort
+from fleming_lib.concepts import MEASUREMENTS
+from fleming_lib.events import StatusPrinter, nbytes, track_stage
+from fleming_lib.fetch import fetch_frame
 from fleming_lib.metrics import (add_age, add_rolling_avg, add_target,
                                  add_super_target)
 from fleming_lib.utils import (add_categories, add_missing_columns,
                                check_length, convert_frac, to_categorical,
-                               to_numeric, to_onehot)
+                               to_onehot)
+from fleming_lib.tools import ConnectionPool
 
+# Rolling averages added for each patient: (column, window in hours)
+ROLLING_FEATURES = [
+    ('Respiratory rate', 2),
+]
 
-def create_dataset(conn, list_patients, n_patients_per_batch=10,
-                   verbose=False):
+# Categorical variables of meta data
+META_CATEGORICAL = ['gender', 'race']
+
+# Errors of the connection considered as query timeouts by default (batches
+# raising them, or MonetDB statement timeouts, are bisected)
+TIMEOUT_ERRORS = (socket.timeout, TimeoutError)
+
+# SQLSTATE and message of MonetDB statement timeouts (raised as
+# `pymonetdb.OperationalError`, e.g. 'HYT00!Query aborted due to timeout')
+_MONETDB_TIMEOUT_CODE = 'HYT00'
+_MONETDB_TIMEOUT_MESSAGE = 'aborted due to timeout'
+
+# Version of the format of cached meta data
+_META_CACHE_VERSION = 2
+
+# Types of the columns returned by measure queries
+_MEASURES_SCHEMA = {
+    'person_id': 'int64',
+    'measurement_datetime': 'datetime64[ns]',
+    'measurement_concept_name': 'object',
+    'value_source_value': 'object',
+    'unit_source_value': 'object',
+    'death_datetime': 'datetime64[ns]',
+}
+_WIDE_MEASURES_SCHEMA = dict(
+    {'person_id': 'int64',
+     'measurement_datetime': 'datetime64[ns]',
+     'death_datetime': 'datetime64[ns]'},
+    **{name: 'object' for name in MEASUREMENTS.names})
+
+# Meta data of every patient
+_META_QUERY = """
+    select
+        distinct p.person_id, p.gender_source_value gender,
+        p.race_source_value race, p.birth_datetime
+    from
+        person p
+        ;"""
+
+# Unique values of categorical measurements (here 'Heart rate rhythm')
+_CATEGORICAL_VALUES_QUERY = """
+        select
+            distinct m.measurement_concept_name, m.value_source_value
+        from
+            measurement m
+        where
+            m.measurement_concept_id in ({})
+        order by
+            m.measurement_concept_name, m.value_source_value
+        ;""".format(MEASUREMENTS.categorical_ids)
+
+
+def create_dataset(conn, list_patients, n_patients_per_batch=10, n_workers=1,
+                   connect=None, pivot='client', cache_dir=None,
+                   cache_ttl=None, cache_key=None, compact=False,
+                   rejected=None, fetch='read_sql', checkpoint_dir=None,
+                   adaptive=False, target_time=60, row_counts=None,
+                   timeout_errors=None, hooks=None, verbose=False):
     """Create list of dataset given a list of patients.
 
+    Batches of `iter_dataset` are built and concatenated: see `iter_dataset`
+    for parameters.
+
+    Returns
+    -------
+    dataset : pd.DataFrame
+        Dataset containing all data associated to each patient, i.e. batches
+        concatenated in order (the index of each batch being kept, it is not
+        unique across batches).
+
+    """
+    frame = list(iter_dataset(conn, list_patients,
+                              n_patients_per_batch=n_patients_per_batch,
+                              n_workers=n_workers, connect=connect,
+                              pivot=pivot, cache_dir=cache_dir,
+                              cache_ttl=cache_ttl, cache_key=cache_key,
+                              compact=compact, rejected=rejected,
+                              fetch=fetch, checkpoint_dir=checkpoint_dir,
+                              adaptive=adaptive, target_time=target_time,
+                              row_counts=row_counts,
+                              timeout_errors=timeout_errors, hooks=hooks,
+                              verbose=verbose))
+
+    # Concat dataframes (columns are already aligned by `iter_dataset`)
+    dataset = pd.concat(frame)
+
+    return dataset
+
+
+def iter_dataset(conn, list_patients, n_patients_per_batch=10, n_workers=1,
+                 connect=None, pivot='client', cache_dir=None, cache_ttl=None,
+                 cache_key=None, compact=False, rejected=None,
+                 fetch='read_sql', checkpoint_dir=None, adaptive=False,
+                 target_time=60, row_counts=None, timeout_errors=None,
+                 hooks=None, verbose=False):
+    """Iterate over dataset batches given a list of patients.
+
+    Each batch is yielded as soon as it is built, so that only one batch is
+    held in memory at a time. Columns of every batch are aligned on the ones
+    of the first batch, so that batches can be consumed (written to disk,
+    imputed, scored...) as they arrive and concatenated afterwards.
+
     Parameters
     ----------
     conn : pymonetdb.connection
         Active connection to the OMOP database.
-    list_patients : list of int
-        List of patients ID.
+    list_patients : list of int | fleming_lib.cohort.Cohort
+        List of patients ID, or cohort materialized in a table of the database
+        (see `fleming_lib.cohort.build_cohort`). With a cohort, batch queries
+        are joined against its table instead of listing patients ID.
     n_patients_per_batch : int (default=10)
         Number of patients to sequentially load data for, in order not to cause
         timeout if the query is too long to process by the server.
+    n_workers : int (default=1)
+        Number of batches to extract concurrently, each one on its own
+        connection taken from a pool of at most `n_workers` connections
+        (`conn` included). Batches are returned in the same order as with
+        `n_workers=1`.
+    connect : callable | None
+        Function called without argument to open the additional connections
+        used when `n_workers > 1`. If None, `connect_to_omop` is used.
+    pivot : 'client' | 'sql' (default='client')
+        Where to convert measures to a timeseries matrix. If 'client', one row
+        per (patient, datetime, concept) is fetched and pivoted with pandas.
+        If 'sql', the server returns one row per (patient, datetime) with one
+        column per concept, which reduces the number of rows transferred.
+        Both give the same dataset.
+    cache_dir : str | None
+        If provided, directory where patients' meta data and categories of
+        categorical variables are cached, so that the corresponding full-table
+        queries are only run once. Use `fleming_lib.cache.clear_cache` to
+        invalidate the cache.
+    cache_ttl : datetime.timedelta | None
+        Time to live of cached data. If None, cached data never expire.
+    cache_key : str | None
+        Additional key identifying the database (e.g. its name) in the cache
+        fingerprint, when several databases share the same cache directory.
+    compact : bool (default=False)
+        If True, return a compact dataset: numerical variables as float32,
+        categorical variables as 'category' (small integer codes) instead of
+        one-hot encoded columns, targets as int8 and `person_id` as int32
+        (`measurement_datetime` is kept as datetime64, i.e. int64 epoch).
+    rejected : list | None
+        If provided, a dataframe of numerical values which could not be
+        converted (and were set to NaN) (columns `person_id`,
+        `measurement_datetime`, `variable` and `value`) is appended to it for
+        each batch containing some.
+    fetch : 'read_sql' | 'cursor' (default='read_sql')
+        How to fetch measures. If 'read_sql', use `pd.read_sql_query`. If
+        'cursor', fetch rows by chunks straight into typed column buffers
+        (see `fleming_lib.fetch.fetch_frame`), which avoids building the
+        whole result as Python objects and inferring types.
+    checkpoint_dir : str | None
+        If provided, directory where each completed batch is durably saved.
+        A rerun with the same arguments loads completed batches from it
+        instead of extracting them again, and so resumes an interrupted build
+        from the first missing batch.
+    adaptive : bool (default=False)
+        If True, `n_patients_per_batch` is only the size of the first batch:
+        the following ones are sized from the throughput (rows per second)
+        observed on previous batches, so that each batch takes about
+        `target_time` seconds. Not available with `n_workers > 1`.
+    target_time : float (default=60)
+        Targeted duration (in seconds) of each batch when `adaptive=True`.
+    row_counts : dict of int | None
+        Number of measures of each patient (passed as a key), e.g. as returned
+        by `count_measures`, used to size batches when `adaptive=True`.
+        If None, patients are assumed to have as many measures as the average
+        patient of previous batches.
+    timeout_errors : tuple of Exception | callable | None
+        Errors raised on query timeout, or function telling whether an error
+        is a timeout (e.g. checking the error code of a cancelled statement).
+        A batch raising a timeout is bisected, each half being retried (down
+        to a single patient). If None, `is_query_timeout` is used: socket
+        timeouts and MonetDB statement timeouts are bisected, other errors of
+        the database (e.g. invalid queries) are raised.
+    hooks : list of callable | None
+        Functions called with the `fleming_lib.events.StageEvent` emitted at
+        the end of each stage (meta data, measures query, target, pivot, type
+        conversion, merge, age, rolling...) of each batch, e.g.
+        `fleming_lib.events.StageSummary` or
+        `fleming_lib.events.JsonLinesWriter`. Hooks may be called from several
+        threads when `n_workers > 1`.
     verbose : bool (default=False)
-        Verbosity level.
+        Verbosity level. If True, a status line is printed at the end of each
+        stage (see `fleming_lib.events.StatusPrinter`).
 
-    Returns
-    -------
-    dataset : pd.DataFrame
-        Dataset containing all data associated to each patient.
+    Yields
+    ------
+    df : pd.DataFrame
+        Dataset containing all data associated to each patient of the batch.
 
     """
     t0 = time.time()
-    frame = []
 
-    if not isinstance(list_patients, list):
+    cohort = None
+    if isinstance(list_patients, Cohort):
+        cohort = list_patients
+        list_patients = cohort.person_ids
+    elif not isinstance(list_patients, list):
         list_patients = [list_patients]
+    if n_workers < 1:
+        raise ValueError('`n_workers` should be strictly positive.')
+    if pivot not in ('client', 'sql'):
+        raise ValueError("`pivot` should be either 'client' or 'sql'.")
+    if fetch not in ('read_sql', 'cursor'):
+        raise ValueError("`fetch` should be either 'read_sql' or 'cursor'.")
+    if adaptive and n_workers > 1:
+        raise ValueError('Adaptive batches are not available with '
+                         '`n_workers > 1`.')
+    if timeout_errors is None:
+        timeout_errors = is_query_timeout
 
     n_patients = len(list_patients)
 
-    # Extract meta data
-    # -----------------
+    hooks = list(hooks) if hooks else []
+    if verbose:
+        printer = StatusPrinter(t0)
+        hooks.append(printer)
+
+    # Extract meta data and categories of categorical variables
+    meta, categories = extract_meta(conn, cache_dir=cache_dir,
+                                    cache_ttl=cache_ttl, cache_key=cache_key,
+                                    hooks=hooks)
+    if not compact:
+        meta = to_onehot(meta, META_CATEGORICAL)
+
+    # Create sublist of patients (batch)
+    if adaptive:
+        # Sublists are planned on the fly
+        n_sublists = '?'
+    else:
+        sublists_patients = [
+            list_patients[i: i+n_patients_per_batch]
+            for i in range(0, n_patients, n_patients_per_batch)]
+        n_sublists = len(sublists_patients)
     if verbose:
-        msg = 'Extracting meta data...'
-        delta_t = str(int(time.time() - t0)) + ' s'
-        print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
+        printer.n_batches = n_sublists
+
+    if checkpoint_dir is not None:
+        key = fingerprint(list_patients, n_patients_per_batch, adaptive,
+                          pivot, compact, MEASUREMENTS.concepts,
+                          ROLLING_FEATURES)
+        checkpoint = Checkpoint(checkpoint_dir, key)
+    else:
+        checkpoint = None
+
+    def load_batch(i):
+        """Load the i-th batch (and its sublist) from checkpoint."""
+        with track_stage(hooks, 'checkpoint', batch=i) as stage:
+            df, batch_rejected, sublist_patients = checkpoint.load(i)
+            stage.rows_out = len(df)
+        if rejected is not None:
+            rejected.extend(batch_rejected)
+        return df, sublist_patients
+
+    def build_batch(conn, i, sublist_patients):
+        """Build the i-th batch on a given connection."""
+        if checkpoint is not None and i in checkpoint:
+            return load_batch(i)[0]
+
+        batch_rejected = []
+
+        def build(sublist_patients):
+            return _build_batch(conn, sublist_patients, meta, categories,
+                                pivot=pivot, compact=compact,
+                                rejected=batch_rejected, fetch=fetch,
+                                cohort=cohort, hooks=hooks, batch=i)
+
+        with track_stage(hooks, 'batch', batch=i) as stage:
+            df = _build_bisect(build, sublist_patients, timeout_errors)
+            stage.rows_out = len(df)
+        if checkpoint is not None:
+            checkpoint.save(i, (df, batch_rejected, sublist_patients))
+        if rejected is not None:
+            rejected.extend(batch_rejected)
+        return df
+
+    if adaptive:
+        batches = _iter_adaptive(build_batch, load_batch, checkpoint, conn,
+                                 list_patients, n_patients_per_batch,
+                                 target_time, row_counts=row_counts)
+    elif n_workers == 1:
+        batches = (build_batch(conn, i, sublist_patients)
+                   for i, sublist_patients in enumerate(sublists_patients))
+    else:
+        batches = _iter_parallel(build_batch, sublists_patients, conn,
+                                 n_workers, connect=connect)
+
+    # Columns of the first batch, used to align the following ones
+    columns = None
+
+    # Extracting data for each patient
+    for df in batches:
+        if columns is None:
+            columns = df.columns
+        else:
+            df = df.reindex(columns=columns)
+
+        yield df
+
+
+def count_measures(conn, list_patients):
+    """Count measures of each patient.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    list_patients : list of int
+        List of patients ID.
+
+    Returns
+    -------
+    row_counts : dict of int
+        Number of measures of each patient (passed as a key). Patients without
+        measures are missing.
+
+    """
+    if not isinstance(list_patients, list):
+        list_patients = [list_patients]
 
     query = """
     select
-        distinct p.person_id, p.gender_source_value gender,
-        p.race_source_value race, p.birth_datetime
+        m.person_id, count(m.measurement_id) n_measures
     from
-        person p
-        ;"""
+        measurement m
+    where
+        m.measurement_concept_id IN ({})
+    and m.person_id in ({})
+    group by m.person_id
+        ;""".format(MEASUREMENTS.concept_ids,
+                    ', '.join(str(person_id) for person_id in list_patients))
 
-    meta = pd.read_sql_query(query, conn)
+    df = pd.read_sql_query(query, conn)
 
-    # Dictionary containing unique categories for each categorical variable
-    categories = dict()
+    return dict(zip(df['person_id'].tolist(), df['n_measures'].tolist()))
 
-    # Convert categorical variable to 'categorical' type
-    categorical_variables = ['gender', 'race']
-    # Extracting categories for each categorical variable
-    categories = add_categories(categories, meta, categorical_variables)
 
-    meta = to_categorical(meta, categorical_variables, categories)
-    meta = to_onehot(meta, categorical_variables)
+def update_dataset(dataset, new_measures, meta, categories, deaths=None,
+                   compact=None):
+    """Update a dataset with new measurements of its patients.
 
-    # Extract unique measurements values from categorical variables
-    # (here 'Heart rate rhythm')
-    query = """
-        select
-            distinct m.measurement_concept_name, m.value_source_value
-        from
-            measurement m
-        where
-            m.measurement_concept_id in
-            (3022318   -- heart_rhythm
-            )
-        order by
-            m.measurement_concept_name, m.value_source_value
-        ;"""
+    Only what the new measurements affect is computed: new rows (whose
+    rolling averages use the existing rows of the patient within the rolling
+    window as history) and targets of patients whose death is recorded in the
+    new measurements (or in `deaths`). Rows of these patients are located
+    with a single vectorized pass over `person_id`, and all computations are
+    restricted to them, so that (but for copying `dataset` into the returned
+    dataframe) the cost of an update is proportional to the number of rows
+    of the updated patients.
 
-    unique_categ_values = pd.read_sql_query(query, conn)
-    categorical_variables = ['Heart rate rhythm']
-    # Adding categories of each categorical variables to dict 'categories'
-    for var in categorical_variables:
-        tmp = unique_categ_values.loc[
-            unique_categ_values.measurement_concept_name == var]
-        tmp.drop('measurement_concept_name', axis=1, inplace=True)
-        tmp.rename(index=str, columns={'value_source_value': var},
-                   inplace=True)
-        categories = add_categories(categories, tmp, var)
+    Parameters
+    ----------
+    dataset : pd.DataFrame
+        Dataset, as returned by `create_dataset`.
+    new_measures : pd.DataFrame
+        New measurements (one row per patient, datetime and concept), e.g. as
+        returned by `fleming_lib.store.refresh_store`. For patients already in
+        `dataset`, they must be posterior to the existing measurements.
+    meta : pd.DataFrame
+        Meta data, as returned by `extract_meta`.
+    categories : dict of pd.core.indexes.base.Index
+        Categories of each categorical variable, as returned by
+        `extract_meta`.
+    deaths : dict of pd.Timestamp | None
+        `death_datetime` of patients (passed as a key), e.g. as returned by
+        `fleming_lib.store.read_deaths`, so that targets of patients whose
+        death is recorded without new measurements are updated too.
+    compact : bool | None
+        Whether `dataset` was built with `compact=True` (see
+        `iter_dataset`), new rows being built the same way. If None, it is
+        detected from the layout of `dataset` (categorical variables not
+        one-hot encoded).
 
-    # Create sublist of patients (batch)
-    sublists_patients = [list_patients[i: i+n_patients_per_batch]
-                         for i in range(0, n_patients, n_patients_per_batch)]
-    n_sublists = len(sublists_patients)
+    Returns
+    -------
+    dataset : pd.DataFrame
+        Updated dataset, new rows being appended at the end.
 
-    # Extracting data for each patient
-    for i, sublist_patients in enumerate(sublists_patients):
-        if verbose:
-            base_msg = 'Batch {}/{}'.format(i+1, n_sublists)
-            msg = base_msg
-            delta_t = str(int(time.time() - t0)) + ' s'
-            print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
-
-        # Extract measures
-        # ----------------
-        if verbose:
-            add_msg = 'Extracting measures...'
-            msg = base_msg + ' - ' + add_msg
-            delta_t = str(int(time.time() - t0)) + ' s'
-            print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
-
-        if len(sublist_patients) == 1:
-            match_person = "m.person_id = {}".format(sublist_patients[0])
+    Notes
+    -----
+    Imputation of the new rows can be done the same way, using `since` in
+    `fleming_lib.preprocessing.fill_last_upto`.
+
+    """
+    if compact is None:
+        compact = all(var in dataset for var in MEASUREMENTS.categorical)
+    if deaths is not None:
+        deaths = pd.Series(deaths, dtype='datetime64[ns]')
+    if len(new_measures) == 0:
+        if deaths is None:
+            return dataset
+        return _update_targets(dataset.copy(), deaths, _patient_rows(
+            dataset, deaths.index))
+
+    new_measures = new_measures.copy()
+    new_measures['measurement_datetime'] = pd.to_datetime(
+        new_measures['measurement_datetime'])
+
+    # Existing rows of updated patients
+    updated = new_measures['person_id'].unique()
+    if deaths is not None:
+        updated = np.union1d(updated, deaths.index.values)
+    rows = _patient_rows(dataset, updated)
+    existing = dataset.iloc[rows]
+
+    # First new timestamp of each patient
+    since = new_measures.groupby('person_id')['measurement_datetime'].min()
+    last = existing.groupby('person_id')['measurement_datetime'].max()
+    common = last.index.intersection(since.index)
+    late = common[since[common] <= last[common]]
+    if len(late):
+        raise ValueError('New measurements should be posterior to existing '
+                         'ones (patients {}).'.format(list(late)))
+
+    # Build new rows, as in `_build_batch`
+    df = _format_measures(new_measures, categories, compact=compact)
+    if not compact:
+        meta = to_onehot(meta.copy(), META_CATEGORICAL)
+    df = pd.merge(df, meta, how='inner', on='person_id')
+    df = add_age(df, round_to_dec=1)
+
+    # Rolling averages of new rows, with existing rows within the largest
+    # window as history
+    if ROLLING_FEATURES:
+        max_window = max(window for _, window in ROLLING_FEATURES)
+        start = existing['person_id'].map(
+            since - timedelta(hours=max_window))
+        history = existing[
+            (existing['measurement_datetime'] >= start).values]
+        df['is_new'] = True
+        df = pd.concat([history.assign(is_new=False), df], sort=False)
+        for column, window in ROLLING_FEATURES:
+            df = add_rolling_avg(df, column, window, by='person_id')
+        df = df[df['is_new'].values.astype(bool)].drop('is_new', axis=1)
+    if compact:
+        df = _to_compact(df)
+
+    n_rows = len(dataset)
+    dataset = pd.concat([dataset, df.reindex(columns=dataset.columns)])
+
+    death = pd.to_datetime(new_measures['death_datetime']).groupby(
+        new_measures['person_id']).max()
+    if deaths is not None:
+        death = pd.concat([death, deaths]).groupby(level=0).max()
+
+    return _update_targets(dataset, death, np.concatenate([
+        rows, np.arange(n_rows, len(dataset))]))
+
+
+def _patient_rows(dataset, person_ids):
+    """Positions of the rows of given patients."""
+    return np.flatnonzero(dataset['person_id'].isin(person_ids).values)
+
+
+def _update_targets(dataset, death, rows):
+    """Update targets of patients whose death is (newly) recorded.
+
+    Only rows at positions `rows` are looked at.
+    """
+    row_death = pd.Series(dataset['person_id'].values[rows]).map(
+        death).values.astype('datetime64[ns]')
+    is_dead = ~np.isnat(row_death)
+    rows = rows[is_dead]
+    target = row_death[is_dead] <= dataset['measurement_datetime'].values[
+        rows]
+    dataset.iloc[rows, dataset.columns.get_loc('target')] = target.astype(
+        dataset['target'].dtype)
+    dataset.iloc[rows, dataset.columns.get_loc('super_target')] = 1
+
+    return dataset
+
+
+def _iter_adaptive(build_batch, load_batch, checkpoint, conn, list_patients,
+                   n_patients_per_batch, target_time, row_counts=None):
+    """Build batches sized from the throughput observed on previous ones.
+
+    Throughput is measured in measures per second if `row_counts` is
+    provided, and in rows of the built batches per second otherwise. After
+    each batch, the number of rows of the next one is set so that it takes
+    about `target_time` seconds, within a factor 2 of the previous one.
+    """
+    n_patients = len(list_patients)
+    target_rows = None
+    rows_per_patient = None
+    if row_counts:
+        rows_per_patient = np.mean(list(row_counts.values()))
+
+    i = 0
+    start = 0
+    while start < n_patients:
+        if checkpoint is not None and i in checkpoint:
+            df, sublist_patients = load_batch(i)
         else:
-            match_person = "m.person_id in {}".format(tuple(sublist_patients))
+            if target_rows is None:
+                stop = min(start + n_patients_per_batch, n_patients)
+            else:
+                # Add patients until the targeted number of rows is reached
+                stop, n_rows = start, 0
+                while stop < n_patients:
+                    estimate = rows_per_patient
+                    if row_counts:
+                        estimate = row_counts.get(list_patients[stop],
+                                                  rows_per_patient)
+                    if stop > start and n_rows + estimate > target_rows:
+                        break
+                    n_rows += estimate
+                    stop += 1
+            sublist_patients = list_patients[start: stop]
 
-        query = """
-        select
-            distinct m.person_id, m.measurement_datetime,
-            m.measurement_concept_name, m.value_source_value,
-            m.unit_source_value, d.death_datetime
-        from
-            measurement m
-        left join
-            death d on d.person_id = m.person_id
-        where
-            measurement_concept_id IN
-            (3022318,   -- heart_rhythm
-             3024171,   -- respiratory_rate
-             3028354,   -- vent_settings
-             3012888,   -- diastolic_bp
-             3027598,   -- map_bp
-             3004249,   -- systolic_bp
-             3027018,   -- heart_rate
-             3020891,   -- temperature
-             3016502,   -- spo2
-             3020716,   -- fio2
-             3032652,   -- glasgow coma scale
-             
-             -- chemicals
-             3019550,   -- sodium serum/plasma (en) | natremie (fr)
-             3023103,   -- potassium serum/plasma (en) | kaliemie (fr)
-             3024128,   -- bilirubin
-             
-             -- hemato
-             3003282    -- Leukocytes [#/volume] in Blood by Manual count
-            )
-        and {}
-        order by measurement_datetime
-            ;""".format(match_person)
-
-        df = pd.read_sql_query(query, conn)
-
-        # Check if data is empty for a patient
-        check_length(df)
-
-        if verbose:
-            add_msg = 'Formatting data...'
-            msg = base_msg + ' - ' + add_msg
-            delta_t = str(int(time.time() - t0)) + ' s'
-            print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
-
-        df['death_datetime'] = pd.to_datetime(df['death_datetime'])
-        df['measurement_datetime'] = pd.to_datetime(df['measurement_datetime'])
-
-        # Add target: patients' death' status
-        # - relative to the measurement datetime ('target')
-        # - relative to the hospital stay ('super-target')
-        df = df.groupby('person_id').apply(add_target)
-        df = df.groupby('person_id').apply(add_super_target)
-
-        # Convert to timeseries matrix
-        df = df.pivot_table(
-            index=['measurement_datetime', 'target',
-                   'super_target', 'person_id'],
-            columns='measurement_concept_name', values='value_source_value',
-            aggfunc='first')
-        df.reset_index(inplace=True)
-        df.columns.name = None
-
-        # Convert types
-        # -------------
-        # Convert to numerical
-        numerical_variables = [
-            'BP diastolic', 'BP systolic', 'Body temperature', 'Heart rate',
-            'Mean blood pressure', 'Glasgow coma scale',
-            'Oxygen concentration breathed',
-            'Mean pressure Respiratory system airway Calculated',
-            'Oxygen saturation in Arterial blood', 'Respiratory rate',
-            'Leukocytes [#/volume] in Blood by Manual count',
-            'Potassium serum/plasma', 'Sodium serum/plasma', 'Total Bilirubin serum/plasma'
-        ]
-
-        df = add_missing_columns(df, numerical_variables)
+            t = time.time()
+            df = build_batch(conn, i, sublist_patients)
+            elapsed = max(time.time() - t, 1e-3)
 
-        df = convert_frac(df, numerical_variables)
-        df = to_numeric(df, numerical_variables)
+            if row_counts:
+                n_rows = sum(row_counts.get(person_id, rows_per_patient)
+                             for person_id in sublist_patients)
+            else:
+                n_rows = len(df)
+                rows_per_patient = max(n_rows / len(sublist_patients), 1)
+            previous_rows = n_rows if target_rows is None else target_rows
+            target_rows = min(max(n_rows / elapsed * target_time,
+                                  previous_rows / 2), previous_rows * 2)
 
-        # Convert to categorical and one-hot encode
-        categorical_variables = ['Heart rate rhythm']
+        start += len(sublist_patients)
+        i += 1
+        yield df
 
-        df = add_missing_columns(df, categorical_variables)
 
-        df = to_categorical(df, categorical_variables, categories)
-        df = to_onehot(df, categorical_variables)
+def _build_bisect(build, sublist_patients, timeout_errors):
+    """Build a batch, bisecting it and retrying each half on timeout."""
+    try:
+        return build(sublist_patients)
+    except Exception as e:
+        if not _is_timeout(e, timeout_errors) or len(sublist_patients) == 1:
+            raise
+        wrn = ('Timeout for a batch of {} patients ({}): splitting it in '
+               'two.'.format(len(sublist_patients), e))
+        warnings.warn(wrn)
+        half = len(sublist_patients) // 2
+        first = _build_bisect(build, sublist_patients[:half], timeout_errors)
+        second = _build_bisect(build, sublist_patients[half:], timeout_errors)
+        return pd.concat([first, second.reindex(columns=first.columns)])
 
-        # Add meta data to measures
-        # -------------------------
-        if verbose:
-            add_msg = 'Adding meta data...'
-            msg = base_msg + ' - ' + add_msg
-            delta_t = str(int(time.time() - t0)) + ' s'
-            print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
 
+def is_query_timeout(error):
+    """Whether an error is a query timeout.
+
+    Parameters
+    ----------
+    error : Exception
+        Error raised while querying the database.
+
+    Returns
+    -------
+    bool
+        True for socket timeouts (`TIMEOUT_ERRORS`) and MonetDB statement
+        timeouts, recognised by their SQLSTATE or message among
+        `pymonetdb.OperationalError`. Other errors (e.g. invalid queries)
+        are not timeouts.
+
+    """
+    if isinstance(error, TIMEOUT_ERRORS):
+        return True
+    error_type = type(error)
+    if (error_type.__name__ != 'OperationalError'
+            or not error_type.__module__.startswith('pymonetdb')):
+        return False
+    message = str(error)
+    return (message.startswith(_MONETDB_TIMEOUT_CODE)
+            or _MONETDB_TIMEOUT_MESSAGE in message.lower())
+
+
+def _is_timeout(error, timeout_errors):
+    """Whether an error is a query timeout."""
+    if callable(timeout_errors) and not isinstance(timeout_errors, type):
+        return bool(timeout_errors(error))
+    return isinstance(error, timeout_errors)
+
+
+def _iter_parallel(build_batch, sublists_patients, conn, n_workers,
+                   connect=None):
+    """Build batches concurrently and yield them in order.
+
+    At most `n_workers` batches are being built (or waiting to be yielded) at
+    any time, each one on a connection taken from a pool which contains `conn`
+    and up to `n_workers - 1` connections opened with `connect`.
+    """
+    pool = ConnectionPool(n_workers, connect=connect, connections=[conn])
+
+    def worker(i, sublist_patients):
+        with pool.connection() as worker_conn:
+            return build_batch(worker_conn, i, sublist_patients)
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for i, sublist_patients in enumerate(sublists_patients):
+                pending.append(executor.submit(worker, i, sublist_patients))
+                if len(pending) >= n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.close()
+
+
+def extract_measures(conn, match_person, fetch='read_sql'):
+    """Extract measures as one row per (patient, datetime, concept).
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    match_person : str
+        SQL condition on measures `m` selecting patients (e.g.
+        `'m.person_id in (1, 2)'`).
+    fetch : 'read_sql' | 'cursor' (default='read_sql')
+        How to fetch measures (see `iter_dataset`).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Measures, with `death_datetime` of each patient.
+
+    """
+    query = """
+    select
+        distinct m.person_id, m.measurement_datetime,
+        m.measurement_concept_name, m.value_source_value,
+        m.unit_source_value, d.death_datetime
+    from
+        measurement m
+    left join
+        death d on d.person_id = m.person_id
+    where
+        measurement_concept_id IN ({})
+    and {}
+    order by measurement_datetime, value_source_value
+        ;""".format(MEASUREMENTS.concept_ids, match_person)
+
+    return _read_query(conn, query, _MEASURES_SCHEMA, fetch)
+
+
+def extract_wide_measures(conn, match_person, fetch='read_sql'):
+    """Extract measures as one row per (patient, datetime).
+
+    The timeseries matrix is built by the server with one conditional
+    aggregation per concept. Taking the minimum value matches the first value
+    kept by the client-side pivot, as measures are ordered by value there.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    match_person : str
+        SQL condition on measures `m` selecting patients (e.g.
+        `'m.person_id in (1, 2)'`).
+    fetch : 'read_sql' | 'cursor' (default='read_sql')
+        How to fetch measures (see `iter_dataset`).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Measures, with `death_datetime` of each patient.
+
+    """
+    columns = ',\n'.join(
+        '        min(case when m.measurement_concept_id = {} '
+        'then m.value_source_value end) as "{}"'.format(concept.concept_id,
+                                                        concept.name)
+        for concept in MEASUREMENTS.concepts)
+
+    query = """
+    select
+        m.person_id, m.measurement_datetime, d.death_datetime,
+{}
+    from
+        measurement m
+    left join
+        death d on d.person_id = m.person_id
+    where
+        m.measurement_concept_id IN ({})
+    and {}
+    group by
+        m.person_id, m.measurement_datetime, d.death_datetime
+    having
+        count(m.value_source_value) > 0
+    order by m.measurement_datetime
+        ;""".format(columns, MEASUREMENTS.concept_ids, match_person)
+
+    return _read_query(conn, query, _WIDE_MEASURES_SCHEMA, fetch)
+
+
+def _read_query(conn, query, schema, fetch='read_sql'):
+    """Run a query with `pd.read_sql_query` or `fetch_frame`."""
+    if fetch == 'cursor':
+        return fetch_frame(conn, query, schema)
+    return pd.read_sql_query(query, conn)
+
+
+def _coerce_numeric(df, variables, rejected=None, dtypes=None):
+    """Convert variables to numerical, setting invalid values to NaN.
+
+    Variables are converted to their type in `dtypes` (if provided).
+    """
+    for var in variables:
+        values = pd.to_numeric(df[var], errors='coerce')
+        if dtypes is not None:
+            values = values.astype(dtypes[var])
+        is_rejected = (values.isnull() & df[var].notnull()).values
+        if is_rejected.any():
+            wrn = ('{} values of column `{}` could not be converted to '
+                   'numerical: setting them to NaN.'.format(
+                       is_rejected.sum(), var))
+            warnings.warn(wrn)
+            if rejected is not None:
+                rejected.append(pd.DataFrame({
+                    'person_id': df['person_id'].values[is_rejected],
+                    'measurement_datetime':
+                        df['measurement_datetime'].values[is_rejected],
+                    'variable': var,
+                    'value': df[var].values[is_rejected]}))
+        df[var] = values
+
+    return df
+
+
+def extract_meta(conn, cache_dir=None, cache_ttl=None, cache_key=None,
+                  hooks=None, verbose=False, t0=None):
+    """Extract patients' meta data and categories of categorical variables.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    cache_dir : str | None
+        If provided, directory where to cache meta data and categories.
+    cache_ttl : datetime.timedelta | None
+        Time to live of cached meta data and categories.
+    cache_key : str | None
+        Additional key identifying the database in the cache fingerprint.
+    hooks : list of callable | None
+        Functions called with the `fleming_lib.events.StageEvent` of the
+        extraction (stage 'meta').
+    verbose : bool (default=False)
+        Verbosity level.
+    t0 : float | None
+        Start time of the extraction (used for verbosity only).
+
+    Returns
+    -------
+    meta : pd.DataFrame
+        Meta data of every patient (with categorical variables
+        `META_CATEGORICAL`).
+    categories : dict of pd.core.indexes.base.Index
+        Categories of each categorical variable.
+
+    """
+    hooks = list(hooks) if hooks else []
+    if verbose:
+        hooks.append(StatusPrinter(t0))
+
+    with track_stage(hooks, 'meta') as stage:
+        if cache_dir is not None:
+            key = fingerprint(_META_QUERY, _CATEGORICAL_VALUES_QUERY,
+                              _META_CACHE_VERSION, cache_key)
+            cached = load_cache(cache_dir, 'meta', key, ttl=cache_ttl)
+            if cached is not None:
+                stage.rows_out = len(cached[0])
+                return cached
+
+        # Extract meta data
+        # -----------------
+        meta = pd.read_sql_query(_META_QUERY, conn)
+
+        # Dictionary containing unique categories for each categorical
+        # variable
+        categories = dict()
+
+        # Convert categorical variable to 'categorical' type
+        categorical_variables = META_CATEGORICAL
+        # Extracting categories for each categorical variable
+        categories = add_categories(categories, meta, categorical_variables)
+
+        meta = to_categorical(meta, categorical_variables, categories)
+
+        # Extract unique measurements values from categorical variables
+        # (here 'Heart rate rhythm')
+        unique_categ_values = pd.read_sql_query(_CATEGORICAL_VALUES_QUERY,
+                                                conn)
+        categorical_variables = MEASUREMENTS.categorical
+        # Adding categories of each categorical variables to dict 'categories'
+        for var in categorical_variables:
+            tmp = unique_categ_values.loc[
+                unique_categ_values.measurement_concept_name == var]
+            tmp.drop('measurement_concept_name', axis=1, inplace=True)
+            tmp.rename(index=str, columns={'value_source_value': var},
+                       inplace=True)
+            categories = add_categories(categories, tmp, var)
+
+        if cache_dir is not None:
+            save_cache(cache_dir, 'meta', key, (meta, categories))
+
+        stage.rows_out = len(meta)
+        if stage.active:
+            stage.bytes_fetched = (nbytes(meta) +
+                                   nbytes(unique_categ_values))
+
+    return meta, categories
+
+
+def _build_batch(conn, sublist_patients, meta, categories, pivot='client',
+                 compact=False, rejected=None, fetch='read_sql', cohort=None,
+                 hooks=None, batch=None):
+    """Extract and format data of a batch of patients.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    sublist_patients : list of int
+        List of patients ID of the batch.
+    meta : pd.DataFrame
+        Meta data as returned by `extract_meta` (one-hot encoded unless
+        `compact=True`).
+    categories : dict of pd.core.indexes.base.Index
+        Categories of each categorical variable.
+    pivot : 'client' | 'sql' (default='client')
+        Where to convert measures to a timeseries matrix (see
+        `iter_dataset`).
+    compact : bool (default=False)
+        Whether to return a compact dataset (see `iter_dataset`).
+    rejected : list | None
+        List to append values which could not be converted to (see
+        `iter_dataset`).
+    fetch : 'read_sql' | 'cursor' (default='read_sql')
+        How to fetch measures (see `iter_dataset`).
+    cohort : fleming_lib.cohort.Cohort | None
+        If provided, cohort containing the patients of the batch (contiguous
+        in the cohort), whose table is used to match them.
+    hooks : list of callable | None
+        Functions called with the `fleming_lib.events.StageEvent` of each
+        stage.
+    batch : int | None
+        Index of the batch (used for events only).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Dataset containing all data associated to each patient of the batch.
+
+    """
+    # Extract measures
+    # ----------------
+    if cohort is not None:
+        match_person = match_cohort(cohort, sublist_patients)
+    elif len(sublist_patients) == 1:
+        match_person = "m.person_id = {}".format(sublist_patients[0])
+    else:
+        match_person = "m.person_id in {}".format(tuple(sublist_patients))
+
+    with track_stage(hooks, 'measures query', batch=batch) as stage:
+        if pivot == 'client':
+            df = extract_measures(conn, match_person, fetch=fetch)
+        else:
+            df = extract_wide_measures(conn, match_person, fetch=fetch)
+        stage.rows_out = len(df)
+        if stage.active:
+            stage.bytes_fetched = nbytes(df)
+
+    # Check if data is empty for a patient
+    check_length(df)
+
+    df = _format_measures(df, categories, pivot=pivot, compact=compact,
+                          rejected=rejected, hooks=hooks, batch=batch)
+
+    # Add meta data to measures
+    # -------------------------
+    with track_stage(hooks, 'merge', batch=batch, rows_in=len(df)) as stage:
         df = pd.merge(df, meta, how='inner', on='person_id')
+        stage.rows_out = len(df)
 
-        # Add additional features
-        # -----------------------
-        if verbose:
-            add_msg = 'Adding additional features...'
-            msg = base_msg + ' - ' + add_msg
-            delta_t = str(int(time.time() - t0)) + ' s'
-            print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
-
-        # - age
-        df = df.groupby('person_id').apply(add_age, round_to_dec=1)
-        # - 2h rolling average respiratory rate
-        df = df.groupby('person_id').apply(
-            add_rolling_avg, column='Respiratory rate', window=2)
-
-        frame.append(df)
-
-        if verbose:
-            add_msg = 'Done'
-            msg = base_msg + ' - ' + add_msg
-            delta_t = str(int(time.time() - t0)) + ' s'
-            print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
-            print('')
-
-    # Concat dataframes
-    dataset = pd.concat(frame)
-    dataset = dataset.reindex_axis(frame[0].columns, axis=1)
+    # Add additional features
+    # -----------------------
+    # - age
+    with track_stage(hooks, 'age', batch=batch, rows_in=len(df)) as stage:
+        df = add_age(df, round_to_dec=1)
+        stage.rows_out = len(df)
+    # - rolling averages
+    with track_stage(hooks, 'rolling', batch=batch, rows_in=len(df)) as stage:
+        for column, window in ROLLING_FEATURES:
+            df = add_rolling_avg(df, column, window, by='person_id')
+        stage.rows_out = len(df)
 
-    return dataset
+    if compact:
+        with track_stage(hooks, 'compact', batch=batch,
+                         rows_in=len(df)) as stage:
+            df = _to_compact(df)
+            stage.rows_out = len(df)
+
+    return df
+
+
+def _to_compact(df):
+    """Downcast types of a batch built with `compact=True`."""
+    for column in df:
+        if column in ('target', 'super_target'):
+            df[column] = df[column].astype('int8')
+        elif column == 'person_id':
+            df[column] = df[column].astype('int32')
+        elif is_float_dtype(df[column]):
+            df[column] = df[column].astype('float32')
+
+    return df
+
+
+def _format_measures(df, categories, pivot='client', compact=False,
+                     rejected=None, hooks=None, batch=None):
+    """Convert extracted measures to a typed timeseries matrix.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Measures, as returned by `extract_measures` (if `pivot='client'`) or
+        `extract_wide_measures` (if `pivot='sql'`).
+    categories : dict of pd.core.indexes.base.Index
+        Categories of each categorical variable.
+    pivot : 'client' | 'sql' (default='client')
+        Where measures were converted to a timeseries matrix.
+    compact : bool (default=False)
+        If True, categorical variables are not one-hot encoded.
+    rejected : list | None
+        List to append values which could not be converted to.
+    hooks : list of callable | None
+        Functions called with the `fleming_lib.events.StageEvent` of each
+        stage.
+    batch : int | None
+        Index of the batch (used for events only).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Timeseries matrix with targets, numerical and one-hot encoded
+        variables.
+
+    """
+    df['death_datetime'] = pd.to_datetime(df['death_datetime'])
+    df['measurement_datetime'] = pd.to_datetime(df['measurement_datetime'])
+
+    # Add target: patients' death' status
+    # - relative to the measurement datetime ('target')
+    # - relative to the hospital stay ('super-target')
+    with track_stage(hooks, 'target', batch=batch, rows_in=len(df)) as stage:
+        df = add_target(df)
+        df = add_super_target(df, by='person_id')
+        stage.rows_out = len(df)
+
+    # Convert to timeseries matrix
+    index = ['measurement_datetime', 'target', 'super_target', 'person_id']
+    with track_stage(hooks, 'pivot', batch=batch, rows_in=len(df)) as stage:
+        if pivot == 'client':
+            df = df.pivot_table(
+                index=index, columns='measurement_concept_name',
+                values='value_source_value', aggfunc='first')
+            df.reset_index(inplace=True)
+            df.columns.name = None
+        else:
+            # Reproduce `pivot_table` layout: rows sorted by index and
+            # concepts without any value dropped
+            concepts = [name for name in MEASUREMENTS.names
+                        if df[name].notnull().any()]
+            df = df.sort_values(index).reset_index(drop=True)
+            df = df.reindex(columns=index + concepts)
+        stage.rows_out = len(df)
+
+    # Convert types
+    # -------------
+    with track_stage(hooks, 'type conversion', batch=batch,
+                     rows_in=len(df)) as stage:
+        # Add missing variables and sort them as in the concept registry
+        df = add_missing_columns(df, MEASUREMENTS.numerical)
+        df = add_missing_columns(df, MEASUREMENTS.categorical)
+        df = df.reindex(columns=index + MEASUREMENTS.names)
+
+        # Convert to the type declared in the registry, so that it does not
+        # depend on the values of the batch
+        numerical_variables = MEASUREMENTS.numerical
+
+        df = convert_frac(df, numerical_variables)
+        df = _coerce_numeric(df, numerical_variables, rejected,
+                             dtypes=MEASUREMENTS.dtypes)
+
+        # Convert to categorical and one-hot encode
+        categorical_variables = MEASUREMENTS.categorical
+
+        df = to_categorical(df, categorical_variables, categories)
+        if not compact:
+            df = to_onehot(df, categorical_variables)
+        stage.rows_out = len(df)
+
+    return df
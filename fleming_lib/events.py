@@ -0,0 +1,229 @@
+"""Instrumentation of the stages of a dataset build.
+
+Each stage of a build (meta data extraction, measures query, pivot, type
+conversion...) emits a `StageEvent` to the hooks passed to `create_dataset`.
+A hook is any callable taking an event, e.g.:
+
+- `JsonLinesWriter`, writing one JSON object per event to a file;
+- `StageSummary`, aggregating events into a per-stage breakdown;
+- `StatusPrinter`, printing a status line per event (used by `verbose=True`).
+"""
+import json
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import pandas as pd
+
+StageEvent = namedtuple('StageEvent', [
+    'stage', 'batch', 'rows_in', 'rows_out', 'bytes_fetched', 'wall_time',
+    'cpu_time'])
+StageEvent.__doc__ = """Event emitted at the end of a stage.
+
+Parameters
+----------
+stage : str
+    Name of the stage (see `STAGES`).
+batch : int | None
+    Index of the batch (from 0), None for stages run once per build.
+rows_in : int | None
+    Number of rows of the input of the stage.
+rows_out : int | None
+    Number of rows of the output of the stage.
+bytes_fetched : int | None
+    Size (in bytes) of the data fetched from the database, for queries.
+wall_time : float
+    Elapsed time (in seconds).
+cpu_time : float
+    CPU time (in seconds) of the thread running the stage.
+"""
+
+# Stages of a build, in order. 'batch' spans all stages of a batch and
+# 'checkpoint' replaces them for batches loaded from a checkpoint.
+STAGES = ['meta', 'measures query', 'target', 'pivot', 'type conversion',
+          'merge', 'age', 'rolling', 'compact', 'checkpoint', 'batch']
+
+
+class _Stage(object):
+    """Outputs of a stage, filled in by the instrumented code."""
+
+    def __init__(self, active):
+        self.active = active
+        self.rows_out = None
+        self.bytes_fetched = None
+
+
+@contextmanager
+def track_stage(hooks, stage, batch=None, rows_in=None):
+    """Time a stage and emit its event to hooks.
+
+    The yielded object has the attributes `rows_out` and `bytes_fetched`,
+    to be set by the instrumented code, and `active` (whether there is any
+    hook), so that costly measures can be skipped. No event is emitted if the
+    stage raises an error.
+
+    Parameters
+    ----------
+    hooks : list of callable | None
+        Functions called with the `StageEvent` at the end of the stage.
+    stage : str
+        Name of the stage.
+    batch : int | None
+        Index of the batch.
+    rows_in : int | None
+        Number of rows of the input of the stage.
+
+    """
+    record = _Stage(bool(hooks))
+    wall_t0 = time.perf_counter()
+    cpu_t0 = time.thread_time()
+    yield record
+    if hooks:
+        event = StageEvent(
+            stage=stage, batch=batch, rows_in=rows_in,
+            rows_out=record.rows_out, bytes_fetched=record.bytes_fetched,
+            wall_time=time.perf_counter() - wall_t0,
+            cpu_time=time.thread_time() - cpu_t0)
+        for hook in hooks:
+            hook(event)
+
+
+def nbytes(df):
+    """Size (in bytes) of a dataframe, including Python objects."""
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+class JsonLinesWriter(object):
+    """Hook writing each event as a JSON object on its own line.
+
+    Parameters
+    ----------
+    file : str | file object
+        Path of the file (events are appended to it) or file object.
+
+    """
+
+    def __init__(self, file):
+        if isinstance(file, str):
+            self._file = open(file, 'a')
+            self._owned = True
+        else:
+            self._file = file
+            self._owned = False
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(dict(event._asdict(), time=time.time()))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        """Close the file, if opened by the writer."""
+        if self._owned:
+            self._file.close()
+
+
+class StageSummary(object):
+    """Hook aggregating events into a per-stage breakdown.
+
+    Examples
+    --------
+    >>> summary = StageSummary()
+    >>> df = create_dataset(conn, list_patients, hooks=[summary])
+    >>> summary.print_summary()
+
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def to_frame(self):
+        """Per-stage breakdown.
+
+        Returns
+        -------
+        df : pd.DataFrame
+            Number of events, sums of rows, bytes fetched, wall and CPU times
+            of each stage (index), sorted as in `STAGES`. Column `wall_share`
+            is the share of the wall time of every stage but 'batch' (which
+            includes the others).
+
+        """
+        columns = ['events', 'rows_in', 'rows_out', 'bytes_fetched',
+                   'wall_time', 'cpu_time', 'wall_share']
+        if not self.events:
+            return pd.DataFrame(columns=columns)
+
+        df = pd.DataFrame(self.events, columns=StageEvent._fields)
+        for column in ('rows_in', 'rows_out', 'bytes_fetched'):
+            df[column] = pd.to_numeric(df[column])
+        summary = df.groupby('stage').agg(
+            {'batch': 'size', 'rows_in': 'sum', 'rows_out': 'sum',
+             'bytes_fetched': 'sum', 'wall_time': 'sum', 'cpu_time': 'sum'})
+        summary.rename(columns={'batch': 'events'}, inplace=True)
+        order = [stage for stage in STAGES if stage in summary.index]
+        order += sorted(set(summary.index) - set(order))
+        summary = summary.reindex(order)
+        stages_wall = summary['wall_time'].drop('batch', errors='ignore').sum()
+        summary['wall_share'] = summary['wall_time'] / stages_wall
+        summary.loc[summary.index == 'batch', 'wall_share'] = float('nan')
+
+        return summary[columns]
+
+    def print_summary(self, file=None):
+        """Print the per-stage breakdown."""
+        summary = self.to_frame()
+        lines = ['{:16s} {:>7s} {:>11s} {:>11s} {:>10s} {:>10s} {:>10s} '
+                 '{:>6s}'.format('stage', 'events', 'rows in', 'rows out',
+                                 'MB', 'wall (s)', 'cpu (s)', 'wall')]
+        for stage, row in summary.iterrows():
+            lines.append(
+                '{:16s} {:7d} {:11.0f} {:11.0f} {:10.1f} {:10.2f} {:10.2f} '
+                '{:>6s}'.format(
+                    stage, int(row['events']), row['rows_in'],
+                    row['rows_out'], row['bytes_fetched'] / 1e6,
+                    row['wall_time'], row['cpu_time'],
+                    '' if pd.isnull(row['wall_share'])
+                    else '{:.0%}'.format(row['wall_share'])))
+        print('\n'.join(lines), file=sys.stdout if file is None else file)
+
+
+class StatusPrinter(object):
+    """Hook printing a status line per event, along with elapsed time.
+
+    Parameters
+    ----------
+    t0 : float | None
+        Start time of the build. If None, time of creation of the printer.
+    n_batches : int | str | None
+        Number of batches, displayed along with the index of each batch.
+
+    """
+
+    def __init__(self, t0=None, n_batches=None):
+        self.t0 = time.time() if t0 is None else t0
+        self.n_batches = n_batches
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if event.batch is None:
+            msg = event.stage
+        elif self.n_batches is None:
+            msg = 'Batch {} - {}'.format(event.batch + 1, event.stage)
+        else:
+            msg = 'Batch {}/{} - {}'.format(event.batch + 1, self.n_batches,
+                                            event.stage)
+        msg += ' ({:.2f} s)'.format(event.wall_time)
+        delta_t = str(int(time.time() - self.t0)) + ' s'
+        with self._lock:
+            # Each batch (or stage run once) ends on its own line
+            end = '\n' if event.stage in ('batch', 'meta') else '\r'
+            print('{:100s} [{:10s}]'.format(msg, delta_t), end=end)
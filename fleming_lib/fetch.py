@@ -0,0 +1,85 @@
+"""Fast fetching of query results into typed column buffers."""
+import numpy as np
+import pandas as pd
+
+
+def fetch_frame(conn, query, schema, chunksize=10000):
+    """Run a query and fetch its result as a dataframe with a known schema.
+
+    Contrary to `pd.read_sql_query`, rows are fetched by chunks with the
+    DB-API `fetchmany` and written straight into one preallocated NumPy
+    buffer per column, with the type given by `schema`. No intermediate list
+    of all rows is built and no type inference is performed.
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    query : str
+        SQL query.
+    schema : dict of str
+        Type of each column of the result (passed as a key), e.g. 'int64',
+        'float64', 'datetime64[ns]' or 'object'. Missing values are only
+        supported in float, datetime and object columns.
+    chunksize : int (default=10000)
+        Number of rows fetched at once.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Result of the query.
+
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query)
+        columns = [description[0] for description in cursor.description]
+        missing = [column for column in columns if column not in schema]
+        if missing:
+            raise ValueError('No type provided for columns {}.'.format(
+                missing))
+        dtypes = [np.dtype(schema[column]) for column in columns]
+
+        capacity = chunksize
+        buffers = [np.empty(capacity, dtype=dtype) for dtype in dtypes]
+        n_rows = 0
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            n_new = len(rows)
+            if n_rows + n_new > capacity:
+                # Grow buffers geometrically
+                capacity = max(2 * capacity, n_rows + n_new)
+                buffers = [_resize(buffer, capacity) for buffer in buffers]
+            # Transpose rows to columns (in C), each column being converted
+            # to its type at once
+            for buffer, dtype, values in zip(buffers, dtypes, zip(*rows)):
+                buffer[n_rows: n_rows + n_new] = _to_array(values, dtype)
+            n_rows += n_new
+    finally:
+        cursor.close()
+
+    return pd.DataFrame({column: buffer[:n_rows]
+                         for column, buffer in zip(columns, buffers)},
+                        columns=columns)
+
+
+def _resize(buffer, capacity):
+    """Copy a buffer into a larger one."""
+    new_buffer = np.empty(capacity, dtype=buffer.dtype)
+    new_buffer[:len(buffer)] = buffer
+    return new_buffer
+
+
+def _to_array(values, dtype):
+    """Convert a column of fetched values (tuple) to a given type."""
+    if dtype.kind in 'MO':
+        # Built with `np.fromiter`, as `np.array` looks for nested sequences
+        # in each object (slow for datetimes and None)
+        objects = np.fromiter(values, dtype=object, count=len(values))
+        if dtype.kind == 'O':
+            return objects
+        # Datetimes may be returned as objects or ISO strings
+        return pd.to_datetime(objects).values.astype(dtype)
+    return np.array(values, dtype=dtype)
@@ -0,0 +1,175 @@
+"""Resampling of the dataset onto a regular time grid.
+
+Rows of the dataset (one per patient and `measurement_datetime`) are binned
+onto a grid of fixed step (e.g. 1 hour) starting at the first measure of each
+patient, all patients and variables being processed at once. The output is a
+dense (patient x time x variable) array, as expected by recurrent models,
+along with observation masks.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from fleming_lib.concepts import MEASUREMENTS
+
+Grid = namedtuple('Grid', ['values', 'mask', 'person_ids', 'starts',
+                           'lengths', 'columns', 'freq'])
+Grid.__doc__ = """Dataset resampled onto a regular time grid.
+
+Parameters
+----------
+values : np.ndarray, shape (n_patients, n_bins, n_columns)
+    Aggregated value of each patient, bin and column (NaN if not observed).
+mask : np.ndarray of bool, shape (n_patients, n_bins, n_columns)
+    Whether the column was observed within the bin.
+person_ids : np.ndarray, shape (n_patients,)
+    Patient of each first index, sorted.
+starts : np.ndarray of datetime64, shape (n_patients,)
+    Start time of the first bin of each patient.
+lengths : np.ndarray of int, shape (n_patients,)
+    Number of bins of each patient, the following ones being padding.
+columns : list of str
+    Column of each last index.
+freq : pd.Timedelta
+    Duration of the bins.
+"""
+
+# Aggregations of the values of a bin
+AGGREGATIONS = ['last', 'first', 'mean', 'min', 'max', 'count']
+
+
+def resample(df, columns=None, freq='1h', agg='last', by='person_id',
+             max_bins=None, dtype='float64'):
+    """Resample the dataset onto a regular time grid.
+
+    The bins of each patient start at its first measure (floored to `freq`),
+    the bin of a row being `(measurement_datetime - start) // freq`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe, with numerical columns, `measurement_datetime` and
+        `by` columns.
+    columns : list of str | None
+        Columns to resample. If None, numerical variables of the concept
+        registry (`fleming_lib.concepts.MEASUREMENTS`) are used.
+    freq : str | pd.Timedelta (default='1h')
+        Duration of the bins.
+    agg : str | dict (default='last')
+        Aggregation of the values of a bin (see `AGGREGATIONS`), or
+        aggregation of each column. Missing values are ignored.
+    by : str (default='person_id')
+        Column identifying patients.
+    max_bins : int | None
+        If provided, only the first `max_bins` bins of each patient are kept.
+    dtype : str (default='float64')
+        Type of the values (e.g. 'float32' to halve memory).
+
+    Returns
+    -------
+    grid : Grid
+        Values, observation masks and index arrays.
+
+    """
+    if columns is None:
+        columns = [column for column in MEASUREMENTS.numerical
+                   if column in df]
+    elif isinstance(columns, str):
+        columns = [columns]
+    if not isinstance(agg, dict):
+        agg = {column: agg for column in columns}
+    for column in columns + ['measurement_datetime', by]:
+        if column not in df:
+            raise ValueError('`{}` not in dataframe.'.format(column))
+    unknown = set(agg[column] for column in columns) - set(AGGREGATIONS)
+    if unknown:
+        raise ValueError('Unknown aggregations {} (available: {}).'.format(
+            sorted(unknown), AGGREGATIONS))
+    freq = pd.Timedelta(freq)
+
+    # Bin of each row
+    patients, person_ids = pd.factorize(df[by], sort=True)
+    times = df['measurement_datetime'].values.astype(
+        'datetime64[ns]').view('int64')
+    step = freq.value
+    starts = pd.Series(times).groupby(patients).min().values
+    starts = starts - starts % step
+    bins = (times - starts[patients]) // step
+    n_patients = len(person_ids)
+    lengths = np.zeros(n_patients, dtype='int64')
+    np.maximum.at(lengths, patients, bins + 1)
+    if max_bins is not None:
+        lengths = np.minimum(lengths, max_bins)
+    n_bins = int(lengths.max()) if n_patients else 0
+    is_kept = bins < n_bins
+
+    # Rows sorted by cell (patient and bin) and time, so that each cell is a
+    # contiguous range
+    order = np.lexsort((times, bins, patients))
+    order = order[is_kept[order]]
+    cells = (patients * n_bins + bins)[order]
+
+    values = np.full((n_patients, n_bins, len(columns)), np.nan, dtype=dtype)
+    mask = np.zeros((n_patients, n_bins, len(columns)), dtype=bool)
+    flat_values = values.reshape(-1, len(columns))
+    flat_mask = mask.reshape(-1, len(columns))
+    for k, column in enumerate(columns):
+        column_values = df[column].values.astype('float64')[order]
+        is_valid = ~np.isnan(column_values)
+        column_values = column_values[is_valid]
+        column_cells = cells[is_valid]
+        if not len(column_cells):
+            continue
+        # First row of each observed cell
+        is_first = np.ones(len(column_cells), dtype=bool)
+        is_first[1:] = column_cells[1:] != column_cells[:-1]
+        firsts = np.flatnonzero(is_first)
+        observed = column_cells[firsts]
+        flat_values[observed, k] = _aggregate(
+            column_values, firsts, agg[column])
+        flat_mask[observed, k] = True
+
+    return Grid(values=values, mask=mask, person_ids=np.asarray(person_ids),
+                starts=starts.astype('datetime64[ns]'), lengths=lengths,
+                columns=list(columns), freq=freq)
+
+
+def _aggregate(values, firsts, agg):
+    """Aggregate sorted values over ranges starting at `firsts`."""
+    lasts = np.append(firsts[1:], len(values)) - 1
+    if agg == 'last':
+        return values[lasts]
+    elif agg == 'first':
+        return values[firsts]
+    elif agg == 'count':
+        return lasts - firsts + 1
+    elif agg == 'mean':
+        return np.add.reduceat(values, firsts) / (lasts - firsts + 1)
+    elif agg == 'min':
+        return np.minimum.reduceat(values, firsts)
+    else:
+        return np.maximum.reduceat(values, firsts)
+
+
+def grid_times(grid):
+    """Start time of each bin of each patient.
+
+    Parameters
+    ----------
+    grid : Grid
+        Resampled dataset, as returned by `resample`.
+
+    Returns
+    -------
+    times : np.ndarray of datetime64, shape (n_patients, n_bins)
+        Start time of each bin (NaT for padding).
+
+    """
+    n_bins = grid.values.shape[1]
+    offsets = np.arange(n_bins) * grid.freq.value
+    times = grid.starts.view('int64')[:, None] + offsets[None, :]
+    times = times.astype('datetime64[ns]')
+    is_padding = np.arange(n_bins)[None, :] >= grid.lengths[:, None]
+    times[is_padding] = np.datetime64('NaT')
+    return times
@@ -1,14 +1,18 @@
 """Add metrics."""
-from datetime import timedelta
-
 import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
 
 from .utils import convert_frac, _all_nat_check
+from .windows import group_cumsum, prefix_rows, prefix_sums, window_bounds
 
 
 def add_age(df, round_to_dec=1):
     """Add column containing 'age' in years.
 
+    Age is computed for all rows at once, so that it can be applied to a
+    dataframe containing several patients.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -27,59 +31,74 @@ def add_age(df, round_to_dec=1):
     if 'measurement_datetime' not in df:
         raise ValueError('Must provide `measurement_datetime` to compute age.')
 
-    def compute_age(row):
-        """Compute age."""
-        return row['measurement_datetime'] - row['birth_datetime']
-
-    df['age'] = df.apply(lambda x: compute_age(x), axis=1)
-    df['age'] = np.round((df['age']).dt.days / 365.25, decimals=round_to_dec)
+    age = df['measurement_datetime'] - df['birth_datetime']
+    df['age'] = np.round(age.dt.days / 365.25, decimals=round_to_dec)
     df.drop('birth_datetime', inplace=True, axis=1)
 
     return df
 
 
-def add_rolling_avg(df, column, window):
+def add_rolling_avg(df, column, window, by=None):
     """Add rolling average computed over a given column.
 
+    The average at a given time is computed over the measures taken within
+    the previous `window` hours, the current time being excluded (i.e. over
+    [t - window, t)). Each row is only compared to the rows of the same
+    patient if `by` is provided, so that all patients are processed at once
+    in O(n log n).
+
     Parameters
     ----------
     df : pd.DataFrame
         Input dataframe.
-    column : str
-        Name of the column to compute rolling mean over.
-    window : int | float
-        Time interval (in hours) to compute rolling average over.
+    column : str | list of str
+        Name of the column(s) to compute rolling mean over.
+    window : int | float | list of int | float
+        Time interval(s) (in hours) to compute rolling average over.
+    by : str | None, optional (default=None)
+        Column identifying patients (e.g. 'person_id'). If None, `df` is
+        assumed to contain a single patient.
 
     Returns
     -------
     df : pd.DataFrame
-        Dataframe with added column.
+        Dataframe with added column `'<column> avg h-<window>'` for each
+        column and window.
 
     """
-    if column not in df:
-        raise ValueError('`{}` not in dataframe.'.format(column))
+    columns = [column] if isinstance(column, str) else list(column)
+    windows = list(window) if isinstance(window, (list, tuple)) else [window]
+    for column in columns:
+        if column not in df:
+            raise ValueError('`{}` not in dataframe.'.format(column))
     if 'measurement_datetime' not in df:
         raise ValueError('Must provide `measurement_datetime` to compute '
                          'rolling average.')
 
-    # Convert to numerical
-    df = convert_frac(df, column)
-
-    def compute_rolling_avg(row, df, column, window):
-        """Compute rolling average."""
-        filter_df = df[
-            (df['measurement_datetime'] >=
-             (row['measurement_datetime'] - timedelta(hours=window))) &
-            (df['measurement_datetime'] < row['measurement_datetime'])]
-        try:
-            return filter_df[column].mean()
-        except ValueError:
-            return float('nan')
-
-    new_column = column + ' avg h-{}'.format(int(window))
-
-    df[new_column] = df.apply(
-        lambda x: compute_rolling_avg(x, df, column, window), axis=1)
+    # Convert to numerical (if not already)
+    to_convert = [column for column in columns
+                  if not is_numeric_dtype(df[column])]
+    if to_convert:
+        df = convert_frac(df, to_convert)
+
+    order, groups, starts, stops = window_bounds(df, windows, by=by)
+    # Rows of the cumulative sums read for each window (computed once)
+    before_stops = prefix_rows(stops, groups)
+    before_starts = [prefix_rows(start, groups) for start in starts]
+    for column in columns:
+        values = df[column].values.astype('float64')[order]
+        is_valid = ~np.isnan(values)
+        sums = group_cumsum(dict(sum=np.where(is_valid, values, 0.),
+                                 count=is_valid.astype('int64')), groups)
+        counts_before = prefix_sums(sums['count'], before_stops)
+        sums_before = prefix_sums(sums['sum'], before_stops)
+        for window, before_start in zip(windows, before_starts):
+            count = counts_before - prefix_sums(sums['count'], before_start)
+            total = sums_before - prefix_sums(sums['sum'], before_start)
+            avg = np.full(len(df), np.nan)
+            avg[order] = np.where(count > 0, total / np.maximum(count, 1),
+                                  np.nan)
+            df[column + ' avg h-{}'.format(int(window))] = avg
 
     return df
 
@@ -87,6 +106,10 @@ def add_rolling_avg(df, column, window):
 def add_target(df, name='target'):
     """Add target (whether the patient is dead at the time of measurement).
 
+    Target is computed for all rows at once, so that it can be applied to a
+    dataframe containing several patients. Rows without `death_datetime`
+    (NaT) have a target of 0.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -106,20 +129,13 @@ def add_target(df, name='target'):
         raise ValueError('Must provide `measurement_datetime` to compute '
                          'target.')
 
-    def compute_target(row):
-        """Compute target value."""
-        if row['death_datetime'] <= row['measurement_datetime']:
-            val = 1
-        else:
-            val = 0
-        return val
-
-    df[name] = df.apply(compute_target, axis=1)
+    df[name] = (df['death_datetime'] <= df['measurement_datetime']).astype(
+        'int64')
 
     return df
 
 
-def add_super_target(df, name='super_target'):
+def add_super_target(df, name='super_target', by=None):
     """Add super-target (whether the patient is dead at the end of its stay).
 
     Parameters
@@ -128,6 +144,10 @@ def add_super_target(df, name='super_target'):
         Input dataframe.
     name : str, optional (default='super_target')
         Name of the 'super-target' column.
+    by : str | None, optional (default=None)
+        Column identifying patients (e.g. 'person_id'), to compute the
+        super-target of all patients at once. If None, `df` is assumed to
+        contain a single patient.
 
     Returns
     -------
@@ -139,9 +159,86 @@ def add_super_target(df, name='super_target'):
         raise ValueError('Must provide `birth_datetime` to compute '
                          'super-target.')
 
-    if not _all_nat_check(df['death_datetime']):
+    if by is not None:
+        df[name] = df['death_datetime'].notnull().groupby(
+            df[by]).transform('any').astype('int64')
+    elif not _all_nat_check(df['death_datetime']):
         df[name] = 1
     else:
         df[name] = 0
 
     return df
+
+
+def add_horizon_targets(df, horizons=('24h', '48h', '72h', '7d'),
+                        name='target', by=None, censor=True):
+    """Add targets (whether the patient dies within given horizons).
+
+    The target of a row for a horizon h is 1 if the patient is dead at the
+    time of measurement + h (as `add_target` for h = 0). All rows and horizons
+    are compared at once to the time of death.
+
+    Patients without `death_datetime` (NaT) are censored: they are known to
+    be alive only up to their last measure, so that targets of horizons going
+    beyond it are unknown (NaN) if `censor`, 0 otherwise.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe.
+    horizons : list of str | pd.Timedelta | int | float
+        Horizons, as timedeltas (e.g. '24h', '7d') or numbers of hours.
+    name : str, optional (default='target')
+        Prefix of the target columns.
+    by : str | None, optional (default=None)
+        Column identifying patients (e.g. 'person_id'), to find the last
+        measure of each patient. If None, `df` is assumed to contain a single
+        patient.
+    censor : bool, optional (default=True)
+        Whether targets beyond the last measure of patients without death are
+        unknown (NaN).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Dataframe with added columns `'<name> h+<horizon>'` (horizon in
+        hours), of type float if `censor`, int otherwise.
+
+    """
+    if 'death_datetime' not in df:
+        raise ValueError('Must provide `death_datetime` to compute targets.')
+    if 'measurement_datetime' not in df:
+        raise ValueError('Must provide `measurement_datetime` to compute '
+                         'targets.')
+    if isinstance(horizons, (str, int, float, pd.Timedelta)):
+        horizons = [horizons]
+    horizons = [pd.Timedelta(hours=horizon)
+                if isinstance(horizon, (int, float)) else
+                pd.Timedelta(horizon) for horizon in horizons]
+
+    measured = df['measurement_datetime'].values.astype(
+        'datetime64[ns]').view('int64')
+    death = df['death_datetime'].values.astype('datetime64[ns]')
+    is_dead = ~np.isnat(death)
+    # Time (in ns) until death, as compared to every horizon at once
+    until_death = death.view('int64') - measured
+    steps = np.array([horizon.value for horizon in horizons], dtype='int64')
+    targets = (is_dead[:, None]
+               & (until_death[:, None] <= steps[None, :])).astype('int64')
+
+    if censor:
+        if by is None:
+            last = measured.max() if len(df) else 0
+        else:
+            last = pd.Series(measured).groupby(
+                df[by].values).transform('max').values
+        is_unknown = (~is_dead[:, None]
+                      & ((last - measured)[:, None] < steps[None, :]))
+        targets = np.where(is_unknown, np.nan, targets)
+
+    for k, horizon in enumerate(horizons):
+        hours = horizon / pd.Timedelta(hours=1)
+        label = int(hours) if hours == int(hours) else hours
+        df['{} h+{}'.format(name, label)] = targets[:, k]
+
+    return df
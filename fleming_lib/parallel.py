@@ -0,0 +1,270 @@
+"""Execution of per-patient stages on a pool of processes.
+
+Patients are split into shards of contiguous rows (a patient is never split)
+and each shard is processed by a worker process. Columns are passed through
+`multiprocessing.shared_memory` rather than pickled: the input dataframe is
+copied once into shared memory, each worker reading the rows of its shard,
+and numerical columns of the results are returned the same way. Only columns
+of Python objects (e.g. strings), sliced to the rows of each shard, and the
+function are pickled.
+
+Any function can be plugged in, depending on `how`:
+
+- 'frame': applied to the dataframe of each shard (several patients), e.g.
+  `add_rolling_avg` with `by='person_id'`;
+- 'patient': applied to each patient, as with `groupby(by).apply`, e.g.
+  `fill_last_upto`;
+- 'row': applied to each row, as with `apply(axis=1)`, e.g.
+  `compute_sofa_score`.
+
+Functions (and their arguments) must be picklable, i.e. defined at the top
+level of a module.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Kinds of functions applied to shards
+HOW = ['frame', 'patient', 'row']
+
+# Name of the index of shards (row positions), so that results keeping it can
+# be told apart from results with their own index (e.g. aggregates)
+_POSITION = '__position__'
+
+
+def apply_by_patient(df, func, kwargs=None, how='frame', by='person_id',
+                     n_workers=None, n_shards=None):
+    """Apply a function to all patients on a pool of processes.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe.
+    func : callable
+        Function applied to each shard, patient or row (see `how`), returning
+        a dataframe (or series). If it keeps the index of its input (possibly
+        filtered or reordered), results are put back into the order of `df`.
+    kwargs : dict | None
+        Keyword arguments of `func` (e.g. `{'by': 'person_id'}` for stages
+        applied to several patients at once).
+    how : str (default='frame')
+        Whether `func` is applied to the dataframe of each shard ('frame'),
+        to each patient ('patient') or to each row ('row').
+    by : str (default='person_id')
+        Column identifying patients.
+    n_workers : int | None
+        Number of processes. If None, number of CPUs.
+    n_shards : int | None
+        Number of shards (balanced in number of rows). If None, 4 shards per
+        process, so that workers finishing early take the next shard.
+
+    Returns
+    -------
+    result : pd.DataFrame | pd.Series
+        Concatenated results. If `func` keeps the index of its input, they are
+        in the order of `df`, along with the index of `df`. Otherwise (e.g.
+        aggregates per patient), they keep the index returned by `func`, in
+        the order of shards.
+
+    """
+    if how not in HOW:
+        raise ValueError('Unknown `how` {} (available: {}).'.format(how, HOW))
+    if by not in df:
+        raise ValueError('`{}` not in dataframe.'.format(by))
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_shards is None:
+        n_shards = 4 * n_workers
+    if kwargs is None:
+        kwargs = dict()
+
+    # Rows sorted by patient (stable), so that shards are contiguous
+    codes = pd.factorize(df[by])[0]
+    order = np.argsort(codes, kind='mergesort')
+    firsts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    cuts = np.unique(np.searchsorted(
+        firsts, np.linspace(0, len(df), n_shards + 1)[1:-1]))
+    bounds = np.concatenate([[0], firsts[cuts[cuts < len(firsts)]],
+                             [len(df)]])
+    bounds = np.unique(bounds)
+
+    blocks = []
+    try:
+        columns = []
+        for column in df:
+            spec, block = _share_column(df[column].values[order])
+            columns.append((column, spec))
+            if block is not None:
+                blocks.append(block)
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(_run_shard, [
+                    (column, _slice_spec(spec, start, stop))
+                    for column, spec in columns], start, stop, func, how, by,
+                    kwargs)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+        # All shards are done: results are read only if all of them
+        # succeeded, but the blocks of every result are unlinked
+        outputs = [future.result() for future in futures
+                   if future.exception() is None]
+        try:
+            for future in futures:
+                future.result()
+            results = [_read_result(output) for output in outputs]
+        finally:
+            for output in outputs:
+                _unlink_result(output)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if not results:
+        return df.iloc[:0]
+    result = pd.concat([frame for frame, _ in results], sort=False)
+
+    # Back to the order (and index) of `df`, if results are indexed by row
+    # positions
+    if all(is_positions for _, is_positions in results):
+        original = order[result.index.values]
+        result = result.iloc[np.argsort(original, kind='mergesort')]
+        result.index = df.index[np.sort(original)]
+
+    return result
+
+
+def _share_column(values):
+    """Copy a column into shared memory, if of a numpy type.
+
+    Returns
+    -------
+    spec : tuple
+        ('shm', name, dtype, shape) for columns in shared memory,
+        ('category', codes spec, categories, ordered) for categorical columns
+        and ('object', values) for other columns.
+    block : SharedMemory | None
+        Shared memory block (to be closed and unlinked by the caller).
+
+    """
+    if isinstance(values, pd.Categorical):
+        spec, block = _share_column(values.codes)
+        return ('category', spec, values.categories, values.ordered), block
+    if not isinstance(values, np.ndarray) or values.dtype.kind == 'O':
+        return ('object', values), None
+    block = shared_memory.SharedMemory(create=True,
+                                       size=max(values.nbytes, 1))
+    shared = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+    shared[...] = values
+    return ('shm', block.name, values.dtype.str, values.shape), block
+
+
+def _slice_spec(spec, start, stop):
+    """Spec of a column for a shard, columns of objects being sliced."""
+    if spec[0] == 'category':
+        return ('category', _slice_spec(spec[1], start, stop)) + spec[2:]
+    if spec[0] == 'object':
+        return ('object', spec[1][start:stop])
+    return spec
+
+
+def _read_column(spec, start=None, stop=None):
+    """Copy (the rows `start:stop` of) a column described by its spec.
+
+    Columns of objects are already sliced (see `_slice_spec`).
+    """
+    if spec[0] == 'category':
+        codes = _read_column(spec[1], start, stop)
+        return pd.Categorical.from_codes(codes, spec[2], ordered=spec[3])
+    if spec[0] == 'object':
+        return spec[1]
+    block = shared_memory.SharedMemory(name=spec[1])
+    try:
+        shared = np.ndarray(spec[3], dtype=np.dtype(spec[2]),
+                            buffer=block.buf)
+        values = shared[start:stop].copy()
+        del shared
+    finally:
+        block.close()
+    return values
+
+
+def _run_shard(columns, start, stop, func, how, by, kwargs):
+    """Apply a function to the rows `start:stop` (run by workers)."""
+    df = pd.DataFrame({column: _read_column(spec, start, stop)
+                       for column, spec in columns},
+                      index=pd.RangeIndex(start, stop, name=_POSITION))
+    if how == 'frame':
+        result = func(df, **kwargs)
+    elif how == 'patient':
+        result = df.groupby(by, group_keys=False, sort=False).apply(
+            func, **kwargs)
+    else:
+        result = df.apply(func, axis=1, **kwargs)
+
+    # Numerical columns of the result are returned through shared memory,
+    # closed but not unlinked: the parent process takes ownership
+    is_series = isinstance(result, pd.Series)
+    is_positions = result.index.name == _POSITION
+    frame = result.to_frame() if is_series else result
+    spec = []
+    blocks = []
+    try:
+        for column in frame:
+            column_spec, block = _share_column(frame[column].values)
+            spec.append((column, column_spec))
+            if block is not None:
+                blocks.append(block)
+        index_spec, block = _share_column(np.asarray(frame.index))
+        if block is not None:
+            blocks.append(block)
+    except Exception:
+        for block in blocks:
+            block.close()
+            block.unlink()
+        raise
+    for block in blocks:
+        block.close()
+
+    return (spec, index_spec, frame.index.name, is_series,
+            getattr(result, 'name', None), is_positions)
+
+
+def _read_result(result):
+    """Rebuild the result of a shard.
+
+    Returns
+    -------
+    frame : pd.DataFrame | pd.Series
+        Result of the shard.
+    is_positions : bool
+        Whether the result is indexed by row positions.
+
+    """
+    spec, index_spec, index_name, is_series, name, is_positions = result
+    columns = {column: _read_column(column_spec)
+               for column, column_spec in spec}
+    index = pd.Index(_read_column(index_spec),
+                     name=None if is_positions else index_name)
+    frame = pd.DataFrame(columns, index=index, columns=[
+        column for column, _ in spec])
+    if is_series:
+        frame = frame.iloc[:, 0]
+        frame.name = name
+    return frame, is_positions
+
+
+def _unlink_result(result):
+    """Unlink the shared memory blocks of the result of a shard."""
+    spec, index_spec = result[:2]
+    for column_spec in [column_spec for _, column_spec in spec] + [
+            index_spec]:
+        if column_spec[0] == 'category':
+            column_spec = column_spec[1]
+        if column_spec[0] == 'shm':
+            block = shared_memory.SharedMemory(name=column_spec[1])
+            block.close()
+            block.unlink()
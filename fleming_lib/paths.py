@@ -5,16 +5,35 @@ import sys
 import yaml
 
 
-def get_userpaths(userconfig_file='userconfig.yml'):
-    """Find user path from user config file."""
-    file = os.path.abspath(
-        os.path.join(os.path.dirname(__file__), '..', 'user',
-                     userconfig_file))
+# Root of the repository
+REPOSITORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def get_userpaths(userconfig_file='userconfig.yml', default=None):
+    """Find user path from user config file.
+
+    Parameters
+    ----------
+    userconfig_file : str (default='userconfig.yml')
+        Name of the user config file, in the `user` directory.
+    default : dict | None
+        Userpaths returned if the file does not exist. If None, an error is
+        raised instead.
+
+    Returns
+    -------
+    userpaths : dict
+        Dictionary containing userpaths.
+
+    """
+    file = os.path.join(REPOSITORY, 'user', userconfig_file)
     if not os.path.isfile(file):
+        if default is not None:
+            return default
         raise ValueError('File {} does not exist.'.format(file))
     with open(file) as f:
-        userpaths = yaml.load(f)['USERPATHS']
-    return userpaths 
+        userpaths = yaml.safe_load(f)['USERPATHS']
+    return userpaths
 
 
 def add_userpath(userpaths=[]):
@@ -45,5 +64,7 @@ def add_userpath(userpaths=[]):
 
 # Import userpaths
 # ----------------
-USERPATHS = get_userpaths()
+# Without user config (e.g. benchmarks run from a clean checkout), the
+# repository is used
+USERPATHS = get_userpaths(default={'FLEMING': REPOSITORY})
 add_userpath(USERPATHS)
@@ -3,14 +3,22 @@ import warnings
 
 from datetime import timedelta
 
+import numpy as np
 import pandas as pd
+from .windows import window_bounds
 from .utils import _check_variables, get_nat_columns
 
 
 def fill_last_upto(df, variables=None, h=timedelta(hours=24),
-                   warning=False):
+                   warning=False, since=None, by=None):
     """Fill missing value in input dataframe up to a given time.
 
+    Each missing value is filled with the last valid value of the variable
+    measured strictly before, if it was measured less than `h` before. Rows
+    are explicitly ordered by `measurement_datetime` (rows measured at the
+    same time keeping their order), so that `df` does not need to be sorted,
+    and all patients and variables are processed at once.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -22,6 +30,16 @@ def fill_last_upto(df, variables=None, h=timedelta(hours=24),
         Time interval to fetch data up to.
     warning : bool
         If True, print warnings.
+    since : datetime.datetime | None
+        If provided, only rows posterior or equal to `since` are filled (e.g.
+        rows just added by `fleming_lib.dataset.update_dataset`). Earlier rows
+        are left untouched and only their last valid value of each variable is
+        looked at, so that the cost is proportional to the number of filled
+        rows. Earlier rows should not have been filled already.
+    by : str | None
+        Column identifying patients (e.g. 'person_id'), so that values are
+        only carried forward within each patient. If None, `df` is assumed to
+        contain a single patient.
 
     Returns
     -------
@@ -35,48 +53,84 @@ def fill_last_upto(df, variables=None, h=timedelta(hours=24),
     # Check variables
     _check_variables(df, variables)
     _check_variables(df, 'measurement_datetime')
+    if by is not None:
+        _check_variables(df, by)
 
     # Process only columns with missing values.
     variables = get_nat_columns(df, variables)
 
-    # Copy input dataframe
-    tmp = df.copy(deep=True)
-
-    # Time-reverse dataframe (assuming it is sorted by measurement_datetime!)
-    tmp = tmp.iloc[::-1]
-
-    def _last_valid(row, df, column, h):
-        """Return last valid value up to time h prior to current datetime."""
-        if pd.isnull(row[column]):  # is missing value
-            # Get last (in time) valid index (but first in loc as dataframe was
-            # time-reversed here)
-            last_valid_index = (
-                df[df['measurement_datetime'] <
-                   row['measurement_datetime']][column].first_valid_index())
-
-            # Check if posterior to -h
-            if last_valid_index is None:
-                if warning:
-                    wrn = ('[WARNING]: could not find valid index anterior to '
-                           '{} for variable {}.'.format(
-                               row['measurement_datetime'], column))
-                    warnings.warn(wrn)
-                return pd.NaT
-            else:
-                if (df.loc[last_valid_index]['measurement_datetime'] -
-                   row['measurement_datetime'] < h):
-                    return df.loc[last_valid_index][column]
-                else:
-                    return pd.NaT
-        else:
-            return row[column]
+    if since is not None:
+        return _fill_last_upto_since(df, variables, h, warning, since, by)
+
+    df = df.copy()
+    if not variables:
+        return df
+
+    # Rows sorted by patient and time, along with the first row of the same
+    # patient measured at the same time or later
+    order, groups, _, stops = window_bounds(df, [], by=by)
+    times = df['measurement_datetime'].values.astype(
+        'datetime64[ns]').view('int64')[order]
+    positions = np.arange(len(df))
+    previous = np.maximum(stops - 1, 0)
+    horizon = pd.Timedelta(h).value
 
-    # Apply function to every column in `columns`
     for var in variables:
-        tmp[var] = df.apply(lambda x: _last_valid(x, tmp, var, h), axis=1)
+        is_valid = df[var].notnull().values[order]
+        # Last valid row up to each row (forward fill of the positions)
+        last_valid = np.maximum.accumulate(np.where(is_valid, positions, -1))
+        source = np.where(stops > 0, last_valid[previous], -1)
+        is_found = (source >= 0) & (groups[np.maximum(source, 0)] == groups)
+        is_recent = times - times[np.maximum(source, 0)] < horizon
+        source = np.where(is_valid, positions,
+                          np.where(is_found & is_recent, source, -1))
+
+        if warning:
+            for row in np.flatnonzero(~is_valid & ~is_found):
+                wrn = ('[WARNING]: could not find valid index anterior to {} '
+                       'for variable {}.'.format(
+                           pd.Timestamp(times[row]), var))
+                warnings.warn(wrn)
+
+        # Back to the order of `df`
+        sources = np.empty(len(df), dtype='int64')
+        sources[order] = np.where(source >= 0, order[source], -1)
+        values = df[var].astype(object).values[sources]
+        values[sources < 0] = pd.NaT
+        df[var] = pd.Series(values, index=df.index).infer_objects()
+
+    return df
 
-    # Time-back-reverse dataframe (assuming it is sorted by
-    # measurement_datetime!)
-    df = tmp.iloc[::-1]
+
+def _fill_last_upto_since(df, variables, h, warning, since, by):
+    """Fill missing values of rows posterior or equal to `since` only."""
+    is_history = (df['measurement_datetime'] < since).values
+    is_tail = ~is_history
+    if not variables or not is_tail.any():
+        return df
+
+    # Keep rows to fill, along with the last valid row of each variable (and
+    # patient) prior to `since` (the only ones a filled value can come from)
+    keep = is_tail.copy()
+    times = df['measurement_datetime'].values
+    for var in variables:
+        valid = np.flatnonzero(is_history & df[var].notnull().values)
+        if not len(valid):
+            continue
+        if by is None:
+            last = times[valid].max()
+        else:
+            last = pd.Series(times[valid]).groupby(
+                df[by].values[valid]).transform('max').values
+        keep[valid[times[valid] == last]] = True
+
+    filled = fill_last_upto(df[keep], variables, h=h, warning=warning, by=by)
+    is_filled_tail = is_tail[keep]
+
+    df = df.copy()
+    for var in variables:
+        values = df[var].astype(object).values
+        values[is_tail] = filled[var].values[is_filled_tail]
+        df[var] = pd.Series(values, index=df.index).infer_objects()
 
     return df
@@ -0,0 +1,244 @@
+"""On-disk ragged storage of the timeseries of each patient.
+
+A built dataset is stored in a directory as:
+
+- `values.npy`: one contiguous (n_rows, n_columns) matrix, rows being sorted
+  by patient and time;
+- `times.npy`: `measurement_datetime` of each row;
+- `person_ids.npy` and `offsets.npy`: sorted patients and the first row of
+  each of them (the rows of the i-th patient being
+  `offsets[i]:offsets[i + 1]`);
+- `meta.json`: columns (and categories of categorical columns).
+
+Arrays are opened as `numpy.memmap`, so that the matrix of a patient is a
+view of the file, and processes reading the same store share the page cache.
+
+Stores are never modified in place, which would expose torn data (or SIGBUS)
+to processes mapping them: files are written into a new hidden directory next
+to `store_dir`, which is a symbolic link atomically replaced to point to it.
+Processes which opened the previous version keep reading it, its files being
+removed from the file system but not truncated.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from .checkpoint import atomic_write
+
+META = 'meta.json'
+
+
+def write_ragged(df, store_dir, columns=None, by='person_id',
+                 dtype='float32'):
+    """Write a dataset as a ragged store.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Dataset, with `measurement_datetime` and `by` columns.
+    store_dir : str
+        Directory of the store (a symbolic link to the directory of its
+        current version), created if it does not exist and atomically
+        replaced otherwise.
+    columns : list of str | None
+        Columns to store, numerical or categorical (stored as their codes,
+        NaN if missing). If None, all numerical and categorical columns but
+        `by`.
+    by : str (default='person_id')
+        Column identifying patients (numerical, so that patients are stored
+        without pickling).
+    dtype : str (default='float32')
+        Type of the values.
+
+    """
+    for column in ('measurement_datetime', by):
+        if column not in df:
+            raise ValueError('`{}` not in dataframe.'.format(column))
+    if not is_numeric_dtype(df[by]):
+        raise ValueError('`{}` must be numerical.'.format(by))
+    if columns is None:
+        columns = [column for column in df if column != by and (
+            is_numeric_dtype(df[column])
+            or isinstance(df[column].dtype, pd.CategoricalDtype))]
+    else:
+        for column in columns:
+            if column not in df:
+                raise ValueError('`{}` not in dataframe.'.format(column))
+
+    store_dir = os.path.abspath(store_dir)
+    parent_dir, name = os.path.split(store_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    version_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.{}-'.format(name))
+    try:
+        # Readable by other users, as a directory created by `os.makedirs`
+        os.chmod(version_dir, 0o755)
+        _write_version(df, version_dir, columns, by, dtype)
+        _swap_version(store_dir, version_dir)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+
+def _write_version(df, version_dir, columns, by, dtype):
+    """Write the files of a store into a new directory."""
+    times = df['measurement_datetime'].values.astype('datetime64[ns]')
+    codes, person_ids = pd.factorize(df[by], sort=True)
+    order = np.lexsort((times.view('int64'), codes))
+    offsets = np.searchsorted(codes[order], np.arange(len(person_ids) + 1))
+
+    # Filled column by column, so that the whole matrix is never in memory
+    values = np.lib.format.open_memmap(
+        os.path.join(version_dir, 'values.npy'), mode='w+', dtype=dtype,
+        shape=(len(df), len(columns)))
+    categories = dict()
+    for k, column in enumerate(columns):
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories[column] = series.cat.categories.tolist()
+            column_values = series.cat.codes.values.astype(dtype)
+            column_values[column_values < 0] = np.nan
+        else:
+            column_values = series.values.astype(dtype)
+        values[:, k] = column_values[order]
+    values.flush()
+    del values
+    np.save(os.path.join(version_dir, 'times.npy'), times[order])
+    np.save(os.path.join(version_dir, 'person_ids.npy'),
+            np.asarray(person_ids))
+    np.save(os.path.join(version_dir, 'offsets.npy'), offsets)
+
+    atomic_write(os.path.join(version_dir, META),
+                 {'columns': list(columns), 'categories': categories,
+                  'by': by}, binary=False)
+
+
+def _swap_version(store_dir, version_dir):
+    """Atomically point `store_dir` to a new version, removing the previous."""
+    previous_dir = None
+    if os.path.islink(store_dir):
+        previous_dir = os.path.realpath(store_dir)
+    elif os.path.isdir(store_dir):
+        # Not written by `write_ragged`: cannot be replaced atomically
+        if os.listdir(store_dir):
+            raise ValueError('{} is a directory, not a ragged store.'.format(
+                store_dir))
+        os.rmdir(store_dir)
+    link = version_dir + '.link'
+    os.symlink(os.path.basename(version_dir), link)
+    try:
+        os.replace(link, store_dir)
+    except BaseException:
+        os.remove(link)
+        raise
+    # Only versions written by `write_ragged` are removed
+    if previous_dir is not None and os.path.dirname(
+            previous_dir) == os.path.dirname(version_dir) and os.path.basename(
+                previous_dir).startswith('.{}-'.format(
+                    os.path.basename(store_dir))):
+        shutil.rmtree(previous_dir, ignore_errors=True)
+
+
+def open_ragged(store_dir):
+    """Open a ragged store (memory-mapped, read-only).
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory of the store, as written by `write_ragged`.
+
+    Returns
+    -------
+    store : RaggedStore
+        Opened store.
+
+    """
+    return RaggedStore(store_dir)
+
+
+class RaggedStore(object):
+    """Memory-mapped ragged store of the timeseries of each patient.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory of the store, as written by `write_ragged`.
+
+    Examples
+    --------
+    >>> store = open_ragged(store_dir)
+    >>> X = store.get_values(person_id)  # view of the file
+    >>> t = store.get_times(person_id)
+
+    """
+
+    def __init__(self, store_dir):
+        # Version of the store at the time it is opened
+        version_dir = os.path.realpath(store_dir)
+        meta_file = os.path.join(version_dir, META)
+        if not os.path.isfile(meta_file):
+            raise ValueError('No ragged store in {}.'.format(store_dir))
+        with open(meta_file) as f:
+            meta = json.load(f)
+        self.store_dir = store_dir
+        self.columns = meta['columns']
+        self.categories = meta['categories']
+        self.by = meta['by']
+        self.values = np.load(os.path.join(version_dir, 'values.npy'),
+                              mmap_mode='r')
+        self.times = np.load(os.path.join(version_dir, 'times.npy'),
+                             mmap_mode='r')
+        self.person_ids = np.load(os.path.join(version_dir, 'person_ids.npy'))
+        self.offsets = np.load(os.path.join(version_dir, 'offsets.npy'))
+
+    def __len__(self):
+        """Number of patients."""
+        return len(self.person_ids)
+
+    def __iter__(self):
+        """Iterate over patients."""
+        return iter(self.person_ids)
+
+    def __contains__(self, person_id):
+        """Whether a patient is in the store."""
+        i = np.searchsorted(self.person_ids, person_id)
+        return i < len(self.person_ids) and self.person_ids[i] == person_id
+
+    def get_slice(self, person_id):
+        """Rows of a patient.
+
+        Returns
+        -------
+        rows : slice
+            Rows of the patient in `values` and `times`.
+
+        """
+        i = np.searchsorted(self.person_ids, person_id)
+        if i == len(self.person_ids) or self.person_ids[i] != person_id:
+            raise ValueError('Unknown patient {}.'.format(person_id))
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def get_values(self, person_id, columns=None):
+        """Matrix of a patient (a view of the file if `columns` is None)."""
+        values = self.values[self.get_slice(person_id)]
+        if columns is not None:
+            values = values[:, [self.columns.index(column)
+                                for column in columns]]
+        return values
+
+    def get_times(self, person_id):
+        """Times of the rows of a patient (a view of the file)."""
+        return self.times[self.get_slice(person_id)]
+
+    def get_frame(self, person_id):
+        """Dataframe of a patient (a copy)."""
+        df = pd.DataFrame(np.array(self.get_values(person_id)),
+                          columns=self.columns)
+        df.insert(0, 'measurement_datetime', np.array(
+            self.get_times(person_id)))
+        df.insert(0, self.by, person_id)
+        return df
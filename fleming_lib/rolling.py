@@ -0,0 +1,207 @@
+"""Rolling statistics over trailing time windows.
+
+Statistics are computed, as rolling averages in `fleming_lib.metrics`, over
+the measures of the same patient taken within the previous `window` hours,
+the current time being excluded (i.e. over [t - window, t)). Rows are sorted
+once by patient and time, then:
+
+- counts, averages, standard deviations and slopes are computed from
+  cumulative sums restarted for each patient;
+- minimums and maximums are computed from a sparse table (minimum/maximum
+  of every range of 2^k rows), which answers each window with two lookups.
+
+The sparse table is used rather than monotonic deques (sliding minimum and
+maximum in O(n)), which need a loop over rows in Python. Its cost is memory:
+for n rows and windows of at most L rows (for the largest window), the table
+holds log2(L) + 1 arrays of n values, i.e. O(n log L) instead of O(n). Tables
+of the minimum and maximum are built for one column at a time (and shared by
+all windows), so that peak memory grows with the log of the longest window
+but not with the number of columns.
+"""
+import numpy as np
+import pandas as pd
+
+from fleming_lib.concepts import MEASUREMENTS
+from fleming_lib.windows import (group_cumsum, prefix_rows, prefix_sums,
+                                 window_bounds)
+
+# Statistics computed by default
+STATS = ['min', 'max', 'std', 'slope', 'count']
+
+# Statistics available
+_ALL_STATS = ['avg'] + STATS
+
+
+def add_rolling_stats(df, columns=None, windows=(2, 6, 24), stats=None,
+                      by='person_id'):
+    """Add rolling statistics of several columns over several windows.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe, with numerical columns and `measurement_datetime`.
+    columns : list of str | None
+        Columns to compute statistics of. If None, numerical variables of the
+        concept registry (`fleming_lib.concepts.MEASUREMENTS`) are used.
+    windows : list of int | float (default=(2, 6, 24))
+        Time intervals (in hours) to compute statistics over.
+    stats : list of str | None
+        Statistics to compute, among:
+
+        - 'avg': average (as `fleming_lib.metrics.add_rolling_avg`);
+        - 'min', 'max': minimum and maximum value;
+        - 'std': standard deviation (with 1 degree of freedom, as pandas);
+        - 'slope': least-squares slope of values against time (per hour);
+        - 'count': number of (non missing) values.
+
+        If None, `STATS` are computed. Statistics are NaN if the window does
+        not contain enough values (1, or 2 for 'std' and 'slope'), except
+        'count' which is 0.
+    by : str | None (default='person_id')
+        Column identifying patients. If None, `df` is assumed to contain a
+        single patient.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Dataframe with added columns `'<column> <stat> h-<window>'`.
+
+    """
+    if columns is None:
+        columns = [column for column in MEASUREMENTS.numerical
+                   if column in df]
+    elif isinstance(columns, str):
+        columns = [columns]
+    if stats is None:
+        stats = STATS
+    elif isinstance(stats, str):
+        stats = [stats]
+    if not isinstance(windows, (list, tuple)):
+        windows = [windows]
+    unknown = [stat for stat in stats if stat not in _ALL_STATS]
+    if unknown:
+        raise ValueError('Unknown statistics {} (available: {}).'.format(
+            unknown, _ALL_STATS))
+    for column in columns + ['measurement_datetime']:
+        if column not in df:
+            raise ValueError('`{}` not in dataframe.'.format(column))
+
+    order, groups, starts, stops = window_bounds(df, windows, by=by)
+    # Rows of the cumulative sums read for each window (computed once)
+    before_stops = prefix_rows(stops, groups)
+    before_starts = [prefix_rows(start, groups) for start in starts]
+    max_length = max(int((stops - start).max()) if len(df) else 0
+                     for start in starts)
+
+    # Time (in hours) relative to the mean time of the patient, to limit
+    # cancellation errors when computing slopes
+    times = df['measurement_datetime'].values.astype(
+        'datetime64[ns]').view('int64')[order]
+    first = np.searchsorted(groups, groups, side='left')
+    hours = (times - times[first]) / 3.6e12
+    hours -= pd.Series(hours).groupby(groups).transform('mean').values
+
+    new_columns = dict()
+    for column in columns:
+        values = df[column].values.astype('float64')[order]
+        is_valid = ~np.isnan(values)
+        # Center values on the mean of each patient, to limit cancellation
+        # errors when computing variances
+        means = pd.Series(values).groupby(groups).transform('mean').values
+        centered = np.where(is_valid, values - means, 0.)
+        t = np.where(is_valid, hours, 0.)
+
+        terms = dict(n=is_valid.astype('float64'), v=centered)
+        if 'std' in stats:
+            terms['vv'] = centered ** 2
+        if 'slope' in stats:
+            terms.update(t=t, tt=t ** 2, tv=t * centered)
+        sums = group_cumsum(terms, groups)
+        after = {key: prefix_sums(cum, before_stops)
+                 for key, cum in sums.items()}
+        # Sparse tables are shared by all windows
+        tables = {stat: _sparse_table(values, max_length, ufunc)
+                  for stat, ufunc in (('min', np.fmin), ('max', np.fmax))
+                  if stat in stats}
+
+        for window, start, before_start in zip(windows, starts,
+                                               before_starts):
+            window_sums = {key: after[key] - prefix_sums(sums[key],
+                                                         before_start)
+                           for key in sums}
+            n = window_sums['n']
+            for stat in stats:
+                if stat == 'count':
+                    result = n
+                elif stat == 'avg':
+                    result = _divide(window_sums['v'], n, n >= 1) + means
+                elif stat == 'std':
+                    variance = _divide(
+                        window_sums['vv'] - window_sums['v'] ** 2
+                        / np.maximum(n, 1), n - 1, n >= 2)
+                    result = np.sqrt(np.maximum(variance, 0.))
+                elif stat == 'slope':
+                    covariance = (n * window_sums['tv']
+                                  - window_sums['t'] * window_sums['v'])
+                    variance = n * window_sums['tt'] - window_sums['t'] ** 2
+                    # Values measured at the same time have no slope
+                    is_defined = (n >= 2) & (
+                        variance > 1e-9 * n * window_sums['tt'])
+                    result = _divide(covariance, variance, is_defined)
+                else:
+                    result = _range_reduce(
+                        tables[stat], start, stops,
+                        np.fmin if stat == 'min' else np.fmax)
+                unsorted = np.empty(len(df))
+                unsorted[order] = result
+                name = '{} {} h-{}'.format(column, stat, int(window))
+                new_columns[name] = unsorted
+
+    for name, values in new_columns.items():
+        df[name] = values
+
+    return df
+
+
+def _divide(numerator, denominator, is_defined):
+    """Divide where defined, NaN elsewhere."""
+    return np.where(is_defined, numerator / np.where(is_defined, denominator,
+                                                     1), np.nan)
+
+
+def _sparse_table(values, max_length, ufunc):
+    """Reductions of all ranges of 2^k rows, for 2^k <= max_length.
+
+    `levels[k][i]` is the reduction of `values[i: i + 2**k]` (if within
+    bounds).
+    """
+    levels = [values]
+    while 2 ** len(levels) <= max_length:
+        half = 2 ** (len(levels) - 1)
+        level = levels[-1].copy()
+        level[:-half] = ufunc(levels[-1][:-half], levels[-1][half:])
+        levels.append(level)
+    return levels
+
+
+def _range_reduce(levels, starts, stops, ufunc):
+    """Reduce values over ranges [start, stop) with `np.fmin` or `np.fmax`.
+
+    `levels` is the sparse table of the values (see `_sparse_table`). Missing
+    values (NaN) are ignored, empty ranges (or ranges of missing values) give
+    NaN.
+    """
+    result = np.full(len(starts), np.nan)
+    lengths = stops - starts
+    is_empty = lengths <= 0
+    if is_empty.all():
+        return result
+
+    # Each range is covered by two (overlapping) ranges of 2**k rows
+    k = np.where(is_empty, -1, np.frexp(np.maximum(lengths, 1))[1] - 1)
+    for level_k, level in enumerate(levels):
+        rows = np.flatnonzero(k == level_k)
+        result[rows] = ufunc(level[starts[rows]],
+                             level[stops[rows] - 2 ** level_k])
+
+    return result
@@ -0,0 +1,208 @@
+"""Training samples over sliding windows of the timeseries of each patient.
+
+A sample is made of `length` consecutive rows (measures) of a patient, its
+label being the label of the last row (e.g. `'target h+24'` as computed by
+`fleming_lib.metrics.add_horizon_targets`). Windows start every `step` rows.
+
+Rows of all patients are stored in one contiguous matrix (e.g. a
+`fleming_lib.ragged` store). Windows are a strided view of that matrix, which
+is only copied for the windows of a batch. Windows are enumerated chunk by
+chunk, so that memory is proportional to the batch size rather than to the
+number of windows.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class WindowSampler(object):
+    """Batches of sliding windows of all patients.
+
+    Parameters
+    ----------
+    values : np.ndarray, shape (n_rows, n_columns)
+        Rows of all patients, sorted by patient and time (possibly a
+        `numpy.memmap`).
+    offsets : np.ndarray, shape (n_patients + 1,)
+        First row of each patient (and number of rows).
+    labels : np.ndarray, shape (n_rows,)
+        Label of each row. Windows whose label is missing (NaN, e.g. censored
+        targets) are skipped.
+    length : int (default=24)
+        Number of rows of each window.
+    step : int (default=1)
+        Number of rows between the starts of two windows of a patient.
+    batch_size : int (default=256)
+        Number of windows of each batch (but the last one).
+    features : list of int | None
+        Columns of `values` to keep. If None, all columns.
+    negative_rate : float (default=1.)
+        Probability to keep a window of label 0, so that rare positives are
+        not swamped (probabilities learnt from subsampled negatives should be
+        corrected accordingly).
+    shuffle : bool (default=False)
+        Whether to visit patients in random order, and to shuffle windows
+        within chunks of `chunk_size` windows.
+    chunk_size : int | None
+        Number of windows enumerated at once. If None, 16 batches.
+    seed : int | None
+        Seed of the random generator (subsampling and shuffling).
+
+    Examples
+    --------
+    >>> store = open_ragged(store_dir)
+    >>> sampler = from_ragged(store, 'target h+24', length=12,
+    ...                       negative_rate=.1)
+    >>> for X, y in sampler:
+    ...     model.partial_fit(X.reshape(len(X), -1), y)
+
+    """
+
+    def __init__(self, values, offsets, labels, length=24, step=1,
+                 batch_size=256, features=None, negative_rate=1.,
+                 shuffle=False, chunk_size=None, seed=None):
+        if values.ndim != 2:
+            raise ValueError('`values` should be a 2D array.')
+        if len(labels) != len(values):
+            raise ValueError('`labels` and `values` should have the same '
+                             'number of rows.')
+        if length < 1 or step < 1 or batch_size < 1:
+            raise ValueError('`length`, `step` and `batch_size` should be '
+                             'positive.')
+        if not 0 < negative_rate <= 1:
+            raise ValueError('`negative_rate` should be in (0, 1].')
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.labels = labels
+        self.length = length
+        self.step = step
+        self.batch_size = batch_size
+        self.features = features
+        self.negative_rate = negative_rate
+        self.shuffle = shuffle
+        self.chunk_size = (16 * batch_size if chunk_size is None
+                           else chunk_size)
+        self.seed = seed
+
+        # Number of windows of each patient
+        lengths = np.diff(self.offsets)
+        self.counts = np.maximum((lengths - length) // step + 1, 0)
+        self.n_windows = int(self.counts.sum())
+
+    def windows(self):
+        """Strided view of all the windows of `length` rows.
+
+        Returns
+        -------
+        windows : np.ndarray, shape (n_rows - length + 1, length, n_columns)
+            Rows `i: i + length` of `values` (a view, not a copy).
+
+        """
+        n_rows, n_columns = self.values.shape
+        stride_row, stride_column = self.values.strides
+        return as_strided(self.values,
+                          shape=(max(n_rows - self.length + 1, 0),
+                                 self.length, n_columns),
+                          strides=(stride_row, stride_row, stride_column),
+                          writeable=False)
+
+    def __iter__(self):
+        """Iterate over batches.
+
+        Yields
+        ------
+        X : np.ndarray, shape (batch_size, length, n_features)
+            Windows of the batch (a copy).
+        y : np.ndarray, shape (batch_size,)
+            Labels of the windows.
+
+        """
+        rng = np.random.RandomState(self.seed)
+        windows = self.windows()
+        if self.shuffle:
+            order = rng.permutation(len(self.counts))
+        else:
+            order = np.arange(len(self.counts))
+        counts = self.counts[order]
+        firsts = np.concatenate([[0], np.cumsum(counts)])
+
+        buffer = np.zeros(0, dtype='int64')
+        for first in range(0, self.n_windows, self.chunk_size):
+            # Start row of each window of the chunk
+            indices = np.arange(first, min(first + self.chunk_size,
+                                           self.n_windows))
+            patients = np.searchsorted(firsts, indices, side='right') - 1
+            starts = (self.offsets[order[patients]]
+                      + (indices - firsts[patients]) * self.step)
+
+            labels = np.asarray(self.labels[starts + self.length - 1],
+                                dtype='float64')
+            is_kept = ~np.isnan(labels)
+            if self.negative_rate < 1:
+                is_kept &= ((labels != 0)
+                            | (rng.uniform(size=len(labels))
+                               < self.negative_rate))
+            starts = starts[is_kept]
+            if self.shuffle:
+                rng.shuffle(starts)
+
+            buffer = np.concatenate([buffer, starts])
+            while len(buffer) >= self.batch_size:
+                yield self._make_batch(windows, buffer[:self.batch_size])
+                buffer = buffer[self.batch_size:]
+
+        if len(buffer):
+            yield self._make_batch(windows, buffer)
+
+    def _make_batch(self, windows, starts):
+        """Copy the windows starting at given rows, along with labels."""
+        if self.features is None:
+            X = windows[starts]
+        else:
+            # Windows and features are selected at once (a single copy)
+            X = windows[np.ix_(starts, np.arange(self.length),
+                               self.features)]
+        y = np.asarray(self.labels[starts + self.length - 1])
+        return X, y
+
+
+def from_ragged(store, label, columns=None,
+                targets=('target', 'super_target'), **kwargs):
+    """Sampler of the windows of a ragged store.
+
+    Parameters
+    ----------
+    store : fleming_lib.ragged.RaggedStore
+        Opened store.
+    label : str
+        Column of the store to use as label (not included in features).
+    columns : list of str | None
+        Columns of the store to use as features. If None, all columns but
+        the label and other targets (see `targets`), which would leak it.
+    targets : tuple of str (default=('target', 'super_target'))
+        Names of target columns, excluded from default features along with
+        targets of horizons (e.g. `'target h+48'`, as named by
+        `fleming_lib.metrics.add_horizon_targets`).
+    **kwargs
+        Other parameters of `WindowSampler`.
+
+    Returns
+    -------
+    sampler : WindowSampler
+        Sampler of the windows of all patients.
+
+    """
+    if label not in store.columns:
+        raise ValueError('`{}` not in store.'.format(label))
+    if columns is None:
+        columns = [column for column in store.columns
+                   if column != label and not _is_target(column, targets)]
+    features = [store.columns.index(column) for column in columns]
+    return WindowSampler(store.values, store.offsets,
+                         store.values[:, store.columns.index(label)],
+                         features=features, **kwargs)
+
+
+def _is_target(column, targets):
+    """Whether a column is a target, or the target of a horizon."""
+    return any(column == target or column.startswith('{} h+'.format(target))
+               for target in targets)
@@ -0,0 +1,276 @@
+"""Local columnar store of raw measurements extracted from the OMOP database.
+
+Measurements are stored as Parquet files partitioned by patient
+(`<store_dir>/person_id=<id>/part-<n>.parquet`). A manifest records, for each
+patient, the most recent `measurement_datetime` already stored (high-water
+mark), so that a refresh only fetches newer measurements, along with its
+`death_datetime` as of the last refresh, so that deaths recorded without new
+measurements are not missed.
+"""
+import glob
+import json
+import os
+import time
+
+import pandas as pd
+
+from fleming_lib.checkpoint import atomic_write
+from fleming_lib.dataset import extract_measures
+from fleming_lib.tools import print_status
+
+MANIFEST = 'manifest.json'
+
+
+def refresh_store(conn, store_dir, list_patients, n_patients_per_batch=10,
+                  verbose=False):
+    """Fetch measurements not stored yet for a list of patients.
+
+    For each patient, only measurements strictly posterior to its high-water
+    mark are fetched (all measurements if the patient is not in the store).
+    Deaths are fetched for all patients, so that deaths recorded since the
+    last refresh are applied to stored measurements (see `read_store` and
+    `read_deaths`).
+
+    Parameters
+    ----------
+    conn : pymonetdb.connection
+        Active connection to the OMOP database.
+    store_dir : str
+        Store directory (created if it does not exist).
+    list_patients : list of int
+        List of patients ID.
+    n_patients_per_batch : int (default=10)
+        Number of patients to sequentially load data for, in order not to cause
+        timeout if the query is too long to process by the server.
+    verbose : bool (default=False)
+        Verbosity level.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        New measurements (one row per patient, datetime and concept), as
+        added to the store. Patients whose death changed without new
+        measurements are not in it (see `read_deaths`).
+
+    """
+    t0 = time.time()
+
+    if not isinstance(list_patients, list):
+        list_patients = [list_patients]
+
+    os.makedirs(store_dir, exist_ok=True)
+    high_water_marks = read_manifest(store_dir)
+    deaths = read_deaths(store_dir)
+
+    n_patients = len(list_patients)
+    sublists_patients = [list_patients[i: i+n_patients_per_batch]
+                         for i in range(0, n_patients, n_patients_per_batch)]
+    n_sublists = len(sublists_patients)
+
+    frame = []
+    for i, sublist_patients in enumerate(sublists_patients):
+        if verbose:
+            print_status('Batch {}/{} - Fetching new measures...'.format(
+                i+1, n_sublists), t0)
+
+        df = extract_measures(
+            conn, _match_new_measures(sublist_patients, high_water_marks))
+        df['death_datetime'] = pd.to_datetime(df['death_datetime'])
+        df['measurement_datetime'] = pd.to_datetime(
+            df['measurement_datetime'])
+
+        _write_partitions(df, store_dir)
+
+        # Deaths are fetched after measures, so that they are at least as
+        # recent as the ones joined to measures
+        new_deaths = _extract_deaths(conn, sublist_patients)
+
+        # Update high-water marks only once data are durably written
+        last_datetimes = df.groupby('person_id')['measurement_datetime'].max()
+        for person_id, last_datetime in last_datetimes.items():
+            high_water_marks[int(person_id)] = last_datetime
+        for person_id in sublist_patients:
+            deaths.pop(person_id, None)
+        deaths.update(new_deaths)
+        _write_manifest(store_dir, high_water_marks, deaths)
+
+        frame.append(df)
+
+    if verbose:
+        print_status('Done', t0)
+        print('')
+
+    if not frame:
+        return pd.DataFrame()
+
+    return pd.concat(frame, ignore_index=True)
+
+
+def read_store(store_dir, list_patients=None):
+    """Read measurements from the store.
+
+    Parameters
+    ----------
+    store_dir : str
+        Store directory.
+    list_patients : list of int | None
+        List of patients ID. If None, read all patients in the store.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Measurements (one row per patient, datetime and concept), sorted by
+        `measurement_datetime`. The most recent `death_datetime` of each
+        patient (in its measurements or as of the last refresh) is propagated
+        to all of its measurements.
+
+    """
+    if list_patients is None:
+        list_patients = sorted(read_manifest(store_dir))
+    elif not isinstance(list_patients, list):
+        list_patients = [list_patients]
+
+    frame = []
+    for person_id in list_patients:
+        for file in sorted(glob.glob(os.path.join(
+                _partition_dir(store_dir, person_id), 'part-*.parquet'))):
+            df = pd.read_parquet(file)
+            df.insert(0, 'person_id', person_id)
+            frame.append(df)
+
+    if not frame:
+        return pd.DataFrame()
+
+    df = pd.concat(frame, ignore_index=True)
+    # Death may have been recorded after older measurements were stored
+    death = df.groupby('person_id')['death_datetime'].transform('max')
+    last_death = df['person_id'].map(read_deaths(store_dir)).astype(
+        'datetime64[ns]')
+    is_later = last_death.notnull() & ~(last_death <= death)
+    df['death_datetime'] = death.where(~is_later, last_death)
+    # Measurements written by a refresh interrupted before its manifest was
+    # updated are fetched again by the next refresh (possibly along with a
+    # newer death, hence after propagating it)
+    df.drop_duplicates(inplace=True)
+    df = df.sort_values(['measurement_datetime', 'person_id'], kind='stable')
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
+def read_manifest(store_dir):
+    """Read high-water marks of the store.
+
+    Parameters
+    ----------
+    store_dir : str
+        Store directory.
+
+    Returns
+    -------
+    high_water_marks : dict of pd.Timestamp
+        Most recent `measurement_datetime` stored for each patient (passed as
+        a key).
+
+    """
+    file = os.path.join(store_dir, MANIFEST)
+    if not os.path.isfile(file):
+        return dict()
+    with open(file) as f:
+        manifest = json.load(f)
+    return {int(person_id): pd.Timestamp(last_datetime)
+            for person_id, last_datetime
+            in manifest['high_water_marks'].items()}
+
+
+def read_deaths(store_dir):
+    """Read deaths of patients as of the last refresh of the store.
+
+    Parameters
+    ----------
+    store_dir : str
+        Store directory.
+
+    Returns
+    -------
+    deaths : dict of pd.Timestamp
+        `death_datetime` of each dead patient (passed as a key), e.g. to be
+        passed to `fleming_lib.dataset.update_dataset`.
+
+    """
+    file = os.path.join(store_dir, MANIFEST)
+    if not os.path.isfile(file):
+        return dict()
+    with open(file) as f:
+        manifest = json.load(f)
+    return {int(person_id): pd.Timestamp(death_datetime)
+            for person_id, death_datetime
+            in manifest.get('deaths', dict()).items()}
+
+
+def _write_manifest(store_dir, high_water_marks, deaths):
+    """Atomically write high-water marks and deaths of the store."""
+    manifest = {
+        'high_water_marks': {
+            str(person_id): last_datetime.isoformat()
+            for person_id, last_datetime in sorted(high_water_marks.items())},
+        'deaths': {
+            str(person_id): death_datetime.isoformat()
+            for person_id, death_datetime in sorted(deaths.items())}}
+    atomic_write(os.path.join(store_dir, MANIFEST), manifest, binary=False)
+
+
+def _write_partitions(df, store_dir):
+    """Append measurements to the partition of each patient (single pass)."""
+    for person_id, group in df.groupby('person_id', sort=False):
+        partition_dir = _partition_dir(store_dir, person_id)
+        os.makedirs(partition_dir, exist_ok=True)
+        n_parts = len(glob.glob(os.path.join(partition_dir,
+                                             'part-*.parquet')))
+        file = os.path.join(partition_dir,
+                            'part-{:05d}.parquet'.format(n_parts))
+        group.drop('person_id', axis=1).to_parquet(file, index=False)
+
+
+def _partition_dir(store_dir, person_id):
+    """Directory containing measurements of a given patient."""
+    return os.path.join(store_dir, 'person_id={}'.format(person_id))
+
+
+def _extract_deaths(conn, sublist_patients):
+    """Most recent `death_datetime` of each dead patient of a list."""
+    query = """
+    select
+        d.person_id, max(d.death_datetime) death_datetime
+    from
+        death d
+    where
+        d.person_id in ({})
+    group by d.person_id
+        ;""".format(', '.join(str(person_id)
+                              for person_id in sublist_patients))
+    df = pd.read_sql_query(query, conn)
+    df['death_datetime'] = pd.to_datetime(df['death_datetime'])
+    return {int(person_id): death_datetime for person_id, death_datetime
+            in zip(df['person_id'], df['death_datetime'])
+            if pd.notnull(death_datetime)}
+
+
+def _match_new_measures(sublist_patients, high_water_marks):
+    """SQL condition matching measurements posterior to high-water marks."""
+    conditions = []
+    new_patients = []
+    for person_id in sublist_patients:
+        if person_id in high_water_marks:
+            conditions.append(
+                "(m.person_id = {} and m.measurement_datetime > '{}')".format(
+                    person_id,
+                    high_water_marks[person_id].strftime(
+                        '%Y-%m-%d %H:%M:%S.%f')))
+        else:
+            new_patients.append(person_id)
+    if new_patients:
+        conditions.append("m.person_id in ({})".format(
+            ', '.join(str(person_id) for person_id in new_patients)))
+
+    return '({})'.format(' or '.join(conditions))
@@ -0,0 +1,380 @@
+"""Synthetic OMOP database, to develop and test without the MIMIC server.
+
+Tables `person`, `visit_occurrence`, `visit_detail`, `care_site`,
+`measurement`, `death` and `drug_exposure` are generated with the columns
+queried by `fleming_lib` and the notebooks, and loaded into an embedded SQLite
+database on which `create_dataset` runs unchanged:
+
+>>> from fleming_lib.dataset import create_dataset
+>>> conn = create_synthetic_omop(n_patients=100)
+>>> df = create_dataset(conn, list(range(1, 101)))
+
+Each patient has one ICU stay, with measures charted at irregular intervals.
+At each charting time, every concept is only recorded with some probability
+(missingness), some values are written as literal fractions 'N/M' or left
+empty.
+"""
+import sqlite3
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from fleming_lib.cohort import LIMITATION_OF_CARE_CONCEPTS
+from fleming_lib.concepts import MEASUREMENT_CONCEPTS
+
+Distribution = namedtuple('Distribution', ['p_record', 'mean', 'std', 'low',
+                                           'high', 'decimals'])
+Distribution.__doc__ = """Distribution of the values of a numerical concept.
+
+Parameters
+----------
+p_record : float
+    Probability for the concept to be recorded at a charting time.
+mean, std : float
+    Mean and standard deviation of the (normal) distribution of values.
+low, high : float
+    Values are clipped to [low, high].
+decimals : int
+    Number of decimals of recorded values.
+"""
+
+# Distribution of numerical measures (by concept name)
+DISTRIBUTIONS = {
+    'Respiratory rate': Distribution(.8, 19, 5, 4, 60, 0),
+    'Mean pressure Respiratory system airway Calculated':
+        Distribution(.1, 11, 3, 2, 40, 0),
+    'BP diastolic': Distribution(.7, 60, 12, 20, 140, 0),
+    'Mean blood pressure': Distribution(.7, 78, 14, 30, 160, 0),
+    'BP systolic': Distribution(.7, 120, 20, 50, 240, 0),
+    'Heart rate': Distribution(.9, 87, 17, 30, 200, 0),
+    'Body temperature': Distribution(.25, 37, .8, 32, 42, 1),
+    'Oxygen saturation in Arterial blood': Distribution(.15, 96, 3, 60, 100,
+                                                        0),
+    'Oxygen concentration breathed': Distribution(.15, 45, 15, 21, 100, 0),
+    'Glasgow coma scale': Distribution(.2, 12, 3, 3, 15, 0),
+    'Sodium serum/plasma': Distribution(.05, 139, 5, 110, 170, 0),
+    'Potassium serum/plasma': Distribution(.05, 4.1, .6, 1.5, 9, 1),
+    'Total Bilirubin serum/plasma': Distribution(.02, 1.5, 2, .1, 40, 1),
+    'Leukocytes [#/volume] in Blood by Manual count':
+        Distribution(.03, 11, 5, .1, 80, 1),
+}
+
+# Values of categorical measures (by concept name) and their probability
+CATEGORIES = {
+    'Heart rate rhythm': (.6, ['SR (Sinus Rhythm)', 'ST (Sinus Tachycardia)',
+                               'AF (Atrial Fibrillation)',
+                               'SB (Sinus Bradycardia)',
+                               '1st AV (First degree AV Block)'],
+                          [.55, .2, .15, .07, .03]),
+}
+
+# Care sites (first ones are ICUs) and probability to stay in each of them
+CARE_SITES = [
+    ('Medical intensive care unit', .35),
+    ('Surgical intensive care unit', .15),
+    ('Coronary care unit', .15),
+    ('Cardiac surgery recovery unit', .15),
+    ('Trauma/surgical intensive care unit', .1),
+    ('Neonatal intensive care unit', .05),
+    ('Emergency department', .05),
+]
+
+# Vasopressors (SOFA score): concept ID and name
+DRUGS = [
+    (1321341, 'Norepinephrine'),
+    (1337860, 'Dopamine'),
+    (1343916, 'Epinephrine'),
+    (1337720, 'Dobutamine'),
+]
+
+# Declared types of date columns, so that SQLite returns datetime objects
+_DATE_TYPES = {
+    'birth_datetime': 'timestamp',
+    'visit_start_date': 'date',
+    'visit_start_datetime': 'timestamp',
+    'visit_end_datetime': 'timestamp',
+    'measurement_datetime': 'timestamp',
+    'death_datetime': 'timestamp',
+    'drug_exposure_start_datetime': 'timestamp',
+    'drug_exposure_end_datetime': 'timestamp',
+}
+
+
+def generate_omop(n_patients=100, mean_interval=1., mean_stay=72.,
+                  p_death=.15, p_limitation=.3, p_frac=.02, p_empty=.01,
+                  p_drug=.3, seed=None):
+    """Generate a synthetic OMOP database.
+
+    Parameters
+    ----------
+    n_patients : int (default=100)
+        Number of patients (`person_id` from 1 to `n_patients`).
+    mean_interval : float (default=1.)
+        Average time (in hours) between two charting times of a patient.
+        Actual intervals are exponentially distributed around a mean drawn for
+        each patient.
+    mean_stay : float (default=72.)
+        Average duration (in hours) of an ICU stay (log-normally distributed).
+    p_death : float (default=.15)
+        Probability for a patient to die at the end of its stay.
+    p_limitation : float (default=.3)
+        Probability for a patient to have a limitation of care.
+    p_frac : float (default=.02)
+        Probability for a numerical value to be written as a fraction 'N/M'.
+    p_empty : float (default=.01)
+        Probability for a recorded value to be empty.
+    p_drug : float (default=.3)
+        Probability for a patient to receive vasopressors.
+    seed : int | None
+        Seed of the random generator.
+
+    Returns
+    -------
+    tables : dict of pd.DataFrame
+        Tables of the database (passed as a key).
+
+    """
+    if n_patients < 1:
+        raise ValueError('`n_patients` should be strictly positive.')
+    rng = np.random.RandomState(seed)
+    person_id = np.arange(1, n_patients + 1)
+
+    # Patients and stays
+    # ------------------
+    # Dates are shifted into the future, as in MIMIC
+    birth = (pd.Timestamp('2050-01-01')
+             + pd.to_timedelta(rng.randint(0, 60 * 365, n_patients), 'D'))
+    age = rng.uniform(16, 90, n_patients) * 365.25
+    start = (birth + pd.to_timedelta(age, 'D')).floor('min')
+    duration = rng.lognormal(np.log(mean_stay) - .5, 1., n_patients)
+    end = start + pd.to_timedelta(duration, 'h').floor('min')
+
+    site_names, site_p = zip(*CARE_SITES)
+    care_site = pd.DataFrame({
+        'care_site_id': np.arange(1, len(CARE_SITES) + 1),
+        'care_site_name': list(site_names),
+        'place_of_service_source_value': list(site_names)})
+
+    person = pd.DataFrame({
+        'person_id': person_id,
+        'gender_source_value': rng.choice(['M', 'F'], n_patients),
+        'race_source_value': rng.choice(
+            ['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC OR LATINO', 'ASIAN',
+             'UNKNOWN/NOT SPECIFIED'], n_patients, p=[.7, .1, .05, .05, .1]),
+        'birth_datetime': birth})
+
+    visit_occurrence = pd.DataFrame({
+        'visit_occurrence_id': person_id,
+        'person_id': person_id,
+        'visit_start_date': start.normalize(),
+        'visit_start_datetime': start,
+        'visit_end_datetime': end,
+        'visit_source_value': person_id + 100000})
+
+    visit_detail = pd.DataFrame({
+        'visit_detail_id': person_id,
+        'person_id': person_id,
+        'visit_occurrence_id': person_id,
+        'care_site_id': rng.choice(care_site['care_site_id'], n_patients,
+                                   p=site_p),
+        'visit_detail_concept_id': 32037,  # Intensive care
+        'visit_type_concept_id': 2000000006,  # ward and physical
+        'visit_start_datetime': start,
+        'visit_end_datetime': end})
+
+    dead = rng.uniform(size=n_patients) < p_death
+    death = pd.DataFrame({
+        'person_id': person_id[dead],
+        'death_datetime': end[dead],
+        'death_type_concept_id': 38003569})  # EHR record patient status
+
+    # Measures
+    # --------
+    # Irregular charting times: exponential intervals (in whole minutes, at
+    # least one) around a mean drawn for each patient, from the start of the
+    # stay. Times past the end of the stay are dropped rather than clipped, so
+    # that times of a patient are distinct.
+    patient_interval = rng.uniform(.5, 1.5, n_patients) * mean_interval
+    n_times = np.maximum(rng.poisson(duration / patient_interval), 1)
+    time_person = np.repeat(np.arange(n_patients), n_times)
+    gaps = 1 + np.floor(rng.exponential(60 * patient_interval[time_person]))
+    # Cumulative sum restarted (at 0) for each patient
+    cumsum = np.cumsum(gaps)
+    firsts = np.cumsum(n_times) - n_times
+    minutes = cumsum - np.repeat(cumsum[firsts], n_times)
+    kept = minutes < 60 * duration[time_person]
+    time_person = time_person[kept]
+    times = (start.values[time_person]
+             + pd.to_timedelta(minutes[kept], 'min').values)
+
+    frame = []
+    for concept in MEASUREMENT_CONCEPTS:
+        if concept.kind == 'categorical':
+            p_record, values, p_values = CATEGORIES[concept.name]
+        else:
+            p_record = DISTRIBUTIONS[concept.name].p_record
+        recorded = np.flatnonzero(rng.uniform(size=len(times)) < p_record)
+        n_values = len(recorded)
+
+        if concept.kind == 'categorical':
+            value = rng.choice(values, n_values, p=p_values).astype(object)
+        else:
+            distribution = DISTRIBUTIONS[concept.name]
+            numbers = np.clip(rng.normal(distribution.mean, distribution.std,
+                                         n_values),
+                              distribution.low, distribution.high)
+            numbers = np.round(numbers, distribution.decimals)
+            value = np.array(['{:g}'.format(number) for number in numbers],
+                             dtype=object)
+            # Some values are written as literal fractions
+            frac = rng.uniform(size=n_values) < p_frac
+            value[frac] = ['{:g}/1'.format(number)
+                           for number in numbers[frac]]
+        value[rng.uniform(size=n_values) < p_empty] = None
+
+        frame.append(pd.DataFrame({
+            'person_id': person_id[time_person[recorded]],
+            'measurement_concept_id': concept.concept_id,
+            'measurement_concept_name': concept.name,
+            'measurement_datetime': times[recorded],
+            'measurement_source_concept_id': 0,
+            'value_source_value': value,
+            'unit_source_value': concept.unit,
+            'visit_detail_id': person_id[time_person[recorded]]}))
+
+    # Limitation of care, recorded at the start of the stay
+    limitation = np.flatnonzero(rng.uniform(size=n_patients) < p_limitation)
+    frame.append(pd.DataFrame({
+        'person_id': person_id[limitation],
+        'measurement_concept_id': 0,
+        'measurement_concept_name': 'No matching concept',
+        'measurement_datetime': start[limitation],
+        'measurement_source_concept_id': rng.choice(
+            LIMITATION_OF_CARE_CONCEPTS, len(limitation)),
+        'value_source_value': 'Do not resuscitate',
+        'unit_source_value': None,
+        'visit_detail_id': person_id[limitation]}))
+
+    measurement = pd.concat(frame, ignore_index=True)
+    measurement.sort_values(['person_id', 'measurement_datetime'],
+                            kind='mergesort', inplace=True)
+    measurement.insert(0, 'measurement_id', np.arange(1, len(measurement) + 1))
+    measurement.reset_index(drop=True, inplace=True)
+
+    # Vasopressors
+    # ------------
+    treated = np.flatnonzero(rng.uniform(size=n_patients) < p_drug)
+    drug = rng.randint(0, len(DRUGS), len(treated))
+    drug_start = start[treated] + pd.to_timedelta(
+        rng.uniform(0, 1, len(treated)) * duration[treated] / 2,
+        'h').floor('min')
+    drug_exposure = pd.DataFrame({
+        'drug_exposure_id': np.arange(1, len(treated) + 1),
+        'person_id': person_id[treated],
+        'drug_concept_id': [DRUGS[k][0] for k in drug],
+        'drug_source_value': [DRUGS[k][1] for k in drug],
+        'drug_exposure_start_datetime': drug_start,
+        'drug_exposure_end_datetime': np.minimum(
+            drug_start + pd.to_timedelta(rng.uniform(1, 24, len(treated)),
+                                         'h').floor('min'),
+            end[treated]),
+        'quantity': np.round(rng.uniform(.01, .5, len(treated)), 3),
+        'visit_detail_id': person_id[treated]})
+
+    return {'person': person, 'visit_occurrence': visit_occurrence,
+            'visit_detail': visit_detail, 'care_site': care_site,
+            'measurement': measurement, 'death': death,
+            'drug_exposure': drug_exposure}
+
+
+def load_omop(tables, path=':memory:'):
+    """Load tables into an SQLite database.
+
+    Parameters
+    ----------
+    tables : dict of pd.DataFrame
+        Tables (passed as a key), e.g. as returned by `generate_omop`.
+        Existing tables are replaced.
+    path : str (default=':memory:')
+        Path of the database file. If ':memory:', the database is only held
+        by the returned connection.
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connection to the database (see `connect_sqlite`).
+
+    """
+    conn = connect_sqlite(path)
+    for name, df in tables.items():
+        df = df.copy()
+        dtype = dict()
+        for column in df:
+            if column in _DATE_TYPES:
+                dtype[column] = _DATE_TYPES[column]
+                # Store dates as ISO strings, parsed back by SQLite
+                if _DATE_TYPES[column] == 'date':
+                    df[column] = df[column].dt.strftime('%Y-%m-%d')
+                else:
+                    df[column] = df[column].dt.strftime('%Y-%m-%d %H:%M:%S')
+        df.to_sql(name, conn, if_exists='replace', index=False, dtype=dtype,
+                  chunksize=100000)
+    cursor = conn.cursor()
+    try:
+        for name in tables:
+            if 'person_id' in tables[name]:
+                cursor.execute('create index {0}_person_id on {0} '
+                               '(person_id)'.format(name))
+    finally:
+        cursor.close()
+    conn.commit()
+
+    return conn
+
+
+def connect_sqlite(path):
+    """Open a connection to an SQLite database generated by `load_omop`.
+
+    Date columns are returned as datetime objects, and the connection can be
+    used from any thread, e.g. as `connect` of `create_dataset` with
+    `n_workers > 1` (`connect=lambda: connect_sqlite(path)`).
+
+    Parameters
+    ----------
+    path : str
+        Path of the database file.
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    """
+    return sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
+                           check_same_thread=False)
+
+
+def create_synthetic_omop(n_patients=100, path=':memory:', seed=None,
+                          **kwargs):
+    """Generate a synthetic OMOP database and load it into SQLite.
+
+    Parameters
+    ----------
+    n_patients : int (default=100)
+        Number of patients (`person_id` from 1 to `n_patients`).
+    path : str (default=':memory:')
+        Path of the database file.
+    seed : int | None
+        Seed of the random generator.
+    **kwargs
+        Additional parameters of `generate_omop`.
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    """
+    return load_omop(generate_omop(n_patients, seed=seed, **kwargs),
+                     path=path)
@@ -9,6 +9,10 @@ __maintainer__ = 'François-Guillaume Fernandez'
 __status__ = 'Development'
 
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 
 import numpy as np
 
@@ -42,6 +46,21 @@ def progress_bar(count, total, status=''):
     sys.stdout.flush()
 
 
+def print_status(msg, t0):
+    """Print status message along with elapsed time since `t0`.
+
+    Parameters
+    ----------
+    msg : str
+        Status message.
+    t0 : float
+        Start time (as returned by `time.time`).
+
+    """
+    delta_t = str(int(time.time() - t0)) + ' s'
+    print('{:100s} [{:10s}]'.format(msg, delta_t), end='\r')
+
+
 def connect_to_omop(login_dict=None):
     """Provide a PostGreSQL connection to the MIMIC db in OMOP format.
 
@@ -68,3 +87,85 @@ def connect_to_omop(login_dict=None):
                              password=login_dict['password'])
 
     return conn
+
+
+class ConnectionPool(object):
+    """Bounded pool of connections to the OMOP database.
+
+    Connections are opened lazily (up to `n_connections`) and handed out to
+    one user at a time, so that several threads can query the database
+    concurrently without sharing a connection.
+
+    Parameters
+    ----------
+    n_connections : int
+        Maximum number of connections held by the pool.
+    connect : callable | None
+        Function called without argument to open a new connection.
+        If None, `connect_to_omop` is used.
+    connections : list of pymonetdb.connection | None
+        Already opened connections to add to the pool. They count in
+        `n_connections` but are not closed by `close`.
+
+    """
+
+    def __init__(self, n_connections, connect=None, connections=None):
+        if n_connections < 1:
+            raise ValueError('`n_connections` should be strictly positive.')
+        if connections is None:
+            connections = []
+        if len(connections) > n_connections:
+            raise ValueError('Too many connections provided for a pool of '
+                             'size {}.'.format(n_connections))
+
+        self.n_connections = n_connections
+        self.connect = connect_to_omop if connect is None else connect
+        self._idle = queue.Queue()
+        self._opened = []
+        self._n_created = len(connections)
+        self._lock = threading.Lock()
+        for conn in connections:
+            self._idle.put(conn)
+
+    def acquire(self):
+        """Get a connection, opening a new one if the pool is not full."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._n_created < self.n_connections
+            if can_open:
+                self._n_created += 1
+        if can_open:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._lock:
+                    self._n_created -= 1
+                raise
+            with self._lock:
+                self._opened.append(conn)
+            return conn
+        # Pool is full: wait for a connection to be released
+        return self._idle.get()
+
+    def release(self, conn):
+        """Give a connection back to the pool."""
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager acquiring then releasing a connection."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close every connection opened by the pool."""
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for conn in opened:
+            conn.close()
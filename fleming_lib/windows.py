@@ -0,0 +1,115 @@
+"""Trailing time windows over measures sorted by patient and time.
+
+Helpers shared by rolling averages (`fleming_lib.metrics`), rolling
+statistics (`fleming_lib.rolling`) and batches of measures
+(`fleming_lib.dataloader`). Rows are sorted once by patient and time, so that
+the bounds of all windows are found at once with `np.searchsorted`, and sums
+over windows are differences of cumulative sums restarted for each patient.
+"""
+import numpy as np
+import pandas as pd
+
+
+def window_bounds(df, windows, by=None):
+    """Bounds of the time windows [t - window, t) of each row.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe, with a `measurement_datetime` column.
+    windows : list of int | float
+        Time intervals (in hours).
+    by : str | None
+        Column identifying patients. If None, all rows belong to the same
+        patient.
+
+    Returns
+    -------
+    order : np.ndarray
+        Positions of rows sorted by patient and time (stable).
+    groups : np.ndarray
+        Patient code of each sorted row.
+    starts : list of np.ndarray
+        For each window, sorted position of the first row of the window of
+        each sorted row.
+    stops : np.ndarray
+        Sorted position of the first row after the window of each sorted row
+        (first row of the same patient at the same time or later).
+
+    """
+    times = df['measurement_datetime'].values.astype(
+        'datetime64[ns]').view('int64')
+    if by is None:
+        codes = np.zeros(len(df), dtype='int64')
+    else:
+        codes = pd.factorize(df[by])[0].astype('int64')
+    order = np.lexsort((times, codes))
+    groups = codes[order]
+    times = times[order]
+
+    stops = searchsorted_by_group(groups, times, times)
+    starts = [searchsorted_by_group(
+        groups, times, times - pd.Timedelta(hours=window).value)
+        for window in windows]
+
+    return order, groups, starts, stops
+
+
+def searchsorted_by_group(groups, times, queries, query_groups=None,
+                          side='left'):
+    """Position of the first row of the same group with time >= query.
+
+    Rows should be sorted by group and time. Times and queries are replaced
+    by their rank, so that (group, rank) can be encoded in a single integer
+    and searched at once. Queries are made within the group of each row,
+    unless `query_groups` is provided. With `side='right'`, the first row
+    with time > query is returned.
+    """
+    if query_groups is None:
+        query_groups = groups
+    n_rows = len(times)
+    ranks = np.unique(np.concatenate([times, queries]),
+                      return_inverse=True)[1].astype('int64')
+    n_ranks = ranks.max() + 1 if len(ranks) else 1
+    keys = groups * n_ranks + ranks[:n_rows]
+    query_keys = query_groups * n_ranks + ranks[n_rows:]
+    return np.searchsorted(keys, query_keys, side=side)
+
+
+def group_cumsum(terms, groups):
+    """Cumulative sums of several arrays, restarted for each group.
+
+    Parameters
+    ----------
+    terms : dict of np.ndarray
+        Arrays (of sorted rows) to sum.
+    groups : np.ndarray
+        Group of each sorted row.
+
+    Returns
+    -------
+    sums : dict of np.ndarray
+        Cumulative sums of each array. Restarting them for each group keeps
+        their magnitude (and rounding errors) from growing with the number of
+        groups.
+
+    """
+    sums = pd.DataFrame(terms).groupby(groups).cumsum()
+    return {key: sums[key].values for key in terms}
+
+
+def prefix_rows(positions, groups):
+    """Rows of the cumulative sums giving the sums before sorted positions.
+
+    `positions` point within the group of each row, or just after its end.
+    -1 if there is no row of the same group before the position.
+    """
+    previous = np.maximum(positions - 1, 0)
+    same_group = (positions > 0) & (groups[previous] == groups)
+    return np.where(same_group, previous, -1)
+
+
+def prefix_sums(cum_values, rows):
+    """Cumulative sums (see `group_cumsum`) at given rows (see
+    `prefix_rows`), 0 for -1."""
+    return np.where(rows >= 0, cum_values[rows], 0)
@@ -0,0 +1,136 @@
+"""Tests of `fleming_lib.dataset`."""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+# Tests are run from the repository, which is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import fleming_lib.dataset  # noqa: E402
+from fleming_lib.dataset import (create_dataset, extract_measures,  # noqa
+                                 extract_meta, is_query_timeout,
+                                 update_dataset)
+from fleming_lib.synthetic import generate_omop, load_omop  # noqa: E402
+
+_N_PATIENTS = 12
+
+
+def _split_omop(seed=0, death_only=()):
+    """Synthetic database, along with the same database before a cut-off
+    time of each patient (60% of its stay, or the whole stay for patients in
+    `death_only`), without any death."""
+    tables = generate_omop(_N_PATIENTS, mean_stay=24., p_death=.5,
+                           seed=seed)
+    measurement = tables['measurement']
+    times = measurement.groupby('person_id')['measurement_datetime']
+    cutoff = times.transform('min') + .6 * (times.transform('max')
+                                            - times.transform('min'))
+    is_death_only = measurement['person_id'].isin(death_only)
+    cutoff[is_death_only] = times.transform('max')[is_death_only]
+    old_tables = dict(tables)
+    old_tables['measurement'] = measurement[
+        measurement['measurement_datetime'] <= cutoff]
+    old_tables['death'] = tables['death'].iloc[:0]
+    return load_omop(tables), load_omop(old_tables), cutoff.groupby(
+        measurement['person_id']).first()
+
+
+def _sorted(df):
+    """Rows sorted by patient and time, so that datasets can be compared."""
+    return df.sort_values(['person_id', 'measurement_datetime'],
+                          kind='mergesort').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_update_dataset(compact):
+    conn, old_conn, cutoff = _split_omop()
+    list_patients = list(range(1, _N_PATIENTS + 1))
+    meta, categories = extract_meta(conn)
+
+    dataset = create_dataset(old_conn, list_patients, compact=compact)
+    new_measures = extract_measures(conn, '({})'.format(' or '.join(
+        "(m.person_id = {} and m.measurement_datetime > '{}')".format(
+            person_id, time.strftime('%Y-%m-%d %H:%M:%S'))
+        for person_id, time in cutoff.items())))
+    result = update_dataset(dataset, new_measures, meta, categories)
+
+    expected = create_dataset(conn, list_patients, compact=compact)
+    pd.testing.assert_frame_equal(_sorted(result), _sorted(expected))
+
+
+def test_update_dataset_deaths():
+    # Deaths are all recorded after the dataset is built: the first dead
+    # patient has no new measurement, its death is only given in `deaths`
+    death = generate_omop(_N_PATIENTS, mean_stay=24., p_death=.5,
+                          seed=0)['death']
+    assert len(death) >= 2
+    death_only = death['person_id'].iloc[:1].tolist()
+    conn, old_conn, cutoff = _split_omop(death_only=death_only)
+    list_patients = list(range(1, _N_PATIENTS + 1))
+    meta, categories = extract_meta(conn)
+
+    dataset = create_dataset(old_conn, list_patients)
+    new_measures = extract_measures(conn, '({})'.format(' or '.join(
+        "(m.person_id = {} and m.measurement_datetime > '{}')".format(
+            person_id, time.strftime('%Y-%m-%d %H:%M:%S'))
+        for person_id, time in cutoff.items())))
+    assert not new_measures['person_id'].isin(death_only).any()
+    assert new_measures['death_datetime'].notnull().any()
+    assert not dataset['super_target'].any()
+    result = update_dataset(
+        dataset, new_measures, meta, categories,
+        deaths=dict(zip(death['person_id'], death['death_datetime'])))
+
+    expected = create_dataset(conn, list_patients)
+    assert expected['person_id'].isin(death_only).any()
+    pd.testing.assert_frame_equal(_sorted(result), _sorted(expected))
+
+
+# Stand-in for `pymonetdb.OperationalError`, which is not installed for tests
+_OperationalError = type('OperationalError', (Exception,),
+                         {'__module__': 'pymonetdb.exceptions'})
+
+
+def test_is_query_timeout():
+    assert is_query_timeout(TimeoutError())
+    assert is_query_timeout(_OperationalError(
+        'HYT00!Query aborted due to timeout'))
+    assert is_query_timeout(_OperationalError('Query aborted due to timeout'))
+    assert not is_query_timeout(_OperationalError(
+        "42S22!SELECT: identifier 'foo' unknown"))
+    assert not is_query_timeout(ValueError('aborted due to timeout'))
+
+
+def test_create_dataset_bisect(monkeypatch):
+    # Queries of more than 3 patients time out
+    conn, _, _ = _split_omop()
+    list_patients = list(range(1, _N_PATIENTS + 1))
+    expected = create_dataset(conn, list_patients, 4)
+
+    sizes = []
+    extract = fleming_lib.dataset.extract_measures
+
+    def extract_timeout(conn, match, *args, **kwargs):
+        sizes.append(match.count(',') + 1)
+        if sizes[-1] > 3:
+            raise _OperationalError('HYT00!Query aborted due to timeout')
+        return extract(conn, match, *args, **kwargs)
+
+    monkeypatch.setattr(fleming_lib.dataset, 'extract_measures',
+                        extract_timeout)
+    with pytest.warns(UserWarning, match='splitting it in two'):
+        result = create_dataset(conn, list_patients, 12)
+    assert sizes == [12, 6, 3, 3, 6, 3, 3]
+    pd.testing.assert_frame_equal(_sorted(result), _sorted(expected))
+
+    # Other errors of the database are raised
+    def extract_error(conn, match, *args, **kwargs):
+        raise _OperationalError("42S22!SELECT: identifier 'foo' unknown")
+
+    monkeypatch.setattr(fleming_lib.dataset, 'extract_measures',
+                        extract_error)
+    with pytest.raises(_OperationalError):
+        create_dataset(conn, list_patients, 12)
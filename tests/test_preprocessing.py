@@ -0,0 +1,103 @@
+"""Tests of `fleming_lib.preprocessing`."""
+import os
+import sys
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Tests are run from the repository, which is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fleming_lib.preprocessing import fill_last_upto  # noqa: E402
+
+
+def _fill_last_upto_brute_force(df, variables, h, by):
+    """Fill each missing value with the last valid value of the patient
+    measured strictly before, less than `h` before (row by row).
+
+    Values which cannot be filled are set to NaT, as in `fill_last_upto`.
+    """
+    result = df.copy()
+    times = df['measurement_datetime'].values
+    for var in variables:
+        values = df[var].values
+        filled = values.astype(object)
+        for i in range(len(df)):
+            if pd.notnull(values[i]):
+                continue
+            filled[i] = pd.NaT
+            last = None
+            for j in range(len(df)):
+                if (df[by].values[j] == df[by].values[i]
+                        and times[j] < times[i] and pd.notnull(values[j])
+                        and (last is None or times[j] >= times[last])):
+                    last = j
+            if last is not None and times[i] - times[last] < np.timedelta64(
+                    h):
+                filled[i] = values[last]
+        result[var] = pd.Series(filled, index=df.index).infer_objects()
+    return result
+
+
+def _random_measures(seed, n_rows=200):
+    """Unsorted measures of a few patients, with missing values and several
+    measures at the same time."""
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'person_id': rng.randint(0, 4, n_rows),
+        'measurement_datetime': pd.Timestamp('2100-01-01')
+        + pd.to_timedelta(rng.randint(0, 96, n_rows), 'h'),
+        'Heart rate': rng.normal(80, 10, n_rows),
+        'Glasgow coma scale': rng.randint(3, 16, n_rows).astype(float)})
+    for var in ('Heart rate', 'Glasgow coma scale'):
+        df.loc[rng.uniform(size=n_rows) < .6, var] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('hours', [1, 6, 24, 1000])
+def test_fill_last_upto_brute_force(seed, hours):
+    df = _random_measures(seed)
+    variables = ['Heart rate', 'Glasgow coma scale']
+    h = timedelta(hours=hours)
+
+    result = fill_last_upto(df, variables, h=h, by='person_id')
+    expected = _fill_last_upto_brute_force(df, variables, h, 'person_id')
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_fill_last_upto_older_than_h():
+    # Values measured h or more before are not carried forward
+    df = pd.DataFrame({
+        'measurement_datetime': pd.to_datetime([
+            '2100-01-01 00:00', '2100-01-01 12:00', '2100-01-02 00:00',
+            '2100-01-02 06:00']),
+        'Heart rate': [80., np.nan, np.nan, np.nan]})
+
+    result = fill_last_upto(df, 'Heart rate', h=timedelta(hours=24))
+    np.testing.assert_array_equal(result['Heart rate'].notnull().values,
+                                  [True, True, False, False])
+    assert result['Heart rate'].iloc[1] == 80.
+
+
+def test_fill_last_upto_since():
+    df = _random_measures(0)
+    variables = ['Heart rate', 'Glasgow coma scale']
+    since = pd.Timestamp('2100-01-03')
+
+    result = fill_last_upto(df, variables, since=since, by='person_id')
+    expected = fill_last_upto(df, variables, by='person_id')
+    is_new = (df['measurement_datetime'] >= since).values
+    # Missing values may be NaN or NaT, depending on the rows filled
+    pd.testing.assert_frame_equal(_normalize(result[is_new]),
+                                  _normalize(expected[is_new]))
+    pd.testing.assert_frame_equal(_normalize(result[~is_new]),
+                                  _normalize(df[~is_new]))
+
+
+def _normalize(df):
+    """Objects with None as missing values."""
+    return df.astype(object).where(df.notnull(), None)
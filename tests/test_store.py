@@ -0,0 +1,88 @@
+"""Tests of `fleming_lib.store`."""
+import os
+import sys
+
+import pandas as pd
+
+# Tests are run from the repository, which is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fleming_lib.dataset import extract_measures  # noqa: E402
+from fleming_lib.store import (read_deaths, read_manifest,  # noqa: E402
+                               read_store, refresh_store)
+from fleming_lib.synthetic import generate_omop, load_omop  # noqa: E402
+
+_N_PATIENTS = 12
+
+
+def _split_omop(death_only, seed=0):
+    """Synthetic database, along with the same database before a cut-off
+    time of each patient (60% of its stay, or the whole stay for patients in
+    `death_only`), without any death."""
+    tables = generate_omop(_N_PATIENTS, mean_stay=24., p_death=.5,
+                           seed=seed)
+    measurement = tables['measurement']
+    times = measurement.groupby('person_id')['measurement_datetime']
+    cutoff = times.transform('min') + .6 * (times.transform('max')
+                                            - times.transform('min'))
+    is_death_only = measurement['person_id'].isin(death_only)
+    cutoff[is_death_only] = times.transform('max')[is_death_only]
+    old_tables = dict(tables)
+    old_tables['measurement'] = measurement[
+        measurement['measurement_datetime'] <= cutoff]
+    old_tables['death'] = tables['death'].iloc[:0]
+    return load_omop(tables), load_omop(old_tables)
+
+
+def _sorted(df):
+    """Rows sorted by all columns, so that measurements can be compared."""
+    df = df.copy()
+    for column in ['measurement_datetime', 'death_datetime']:
+        df[column] = pd.to_datetime(df[column])
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_refresh_store(tmp_path):
+    # Deaths are all recorded after the first refresh: the first dead
+    # patient has no new measurement
+    death = generate_omop(_N_PATIENTS, mean_stay=24., p_death=.5,
+                          seed=0)['death']
+    death_only = death['person_id'].iloc[:1].tolist()
+    conn, old_conn = _split_omop(death_only)
+    list_patients = list(range(1, _N_PATIENTS + 1))
+    match = 'm.person_id in ({})'.format(
+        ', '.join(str(person_id) for person_id in list_patients))
+    store_dir = str(tmp_path / 'store')
+
+    old = refresh_store(old_conn, store_dir, list_patients, 5)
+    pd.testing.assert_frame_equal(
+        _sorted(old), _sorted(extract_measures(old_conn, match)),
+        check_dtype=False)
+    high_water_marks = read_manifest(store_dir)
+    assert high_water_marks == old.groupby('person_id')[
+        'measurement_datetime'].max().to_dict()
+    assert read_deaths(store_dir) == dict()
+
+    # Only measurements strictly posterior to high-water marks are fetched
+    new = refresh_store(conn, store_dir, list_patients, 5)
+    measures = extract_measures(conn, match)
+    measures['measurement_datetime'] = pd.to_datetime(
+        measures['measurement_datetime'])
+    is_new = measures['measurement_datetime'].values > measures[
+        'person_id'].map(high_water_marks).values
+    assert is_new.any() and not is_new.all()
+    pd.testing.assert_frame_equal(_sorted(new), _sorted(measures[is_new]),
+                                  check_dtype=False)
+    assert not new['person_id'].isin(death_only).any()
+    assert set(read_deaths(store_dir)) == set(death['person_id'])
+
+    # Deaths are propagated to measurements stored before, including those
+    # of patients without new measurements
+    result = read_store(store_dir)
+    assert result['person_id'].isin(death_only).any()
+    pd.testing.assert_frame_equal(_sorted(result), _sorted(measures),
+                                  check_dtype=False)
+
+    # Nothing is fetched once the store is up to date
+    assert len(refresh_store(conn, store_dir, list_patients, 5)) == 0